@@ -0,0 +1,310 @@
+# aggregate.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Popularity, co-occurrence and breakdowns over many submissions
+
+Submissions are stored column by column: every app, extension, provider
+and category string is interned to an integer ID, list keys are kept as
+CSR membership arrays and category keys as one code per submission.
+NumPy is used when installed, plain Python otherwise.
+Run with: python3 -m accumulate.aggregate submissions.jsonl|STORE [--top N]
+"""
+
+import os
+import json
+import argparse
+import collections
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# ~ List keys and the ID namespace of their items, keys sharing one
+# ~ namespace share IDs, so installed and favourited apps line up
+LIST_KEYS = {
+    "Installed apps": "apps",
+    "Favourited apps": "apps",
+    "Enabled extensions": "extensions",
+    "Online accounts": "providers",
+}
+
+# ~ Keys holding one category per submission
+CATEGORY_KEYS = ("Default browser", "Hardware vendor", "Operating system")
+
+
+class Interner():
+    """Maps strings to dense integer IDs, in order of first appearance"""
+
+    def __init__(self):
+        self.ids = dict()
+        self.strings = []
+
+    def intern(self, string: str) -> int:
+        id = self.ids.get(string)
+        if id is None:
+            id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return id
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, id: int) -> str:
+        return self.strings[id]
+
+
+class MembershipColumn():
+    """The items of a list key, for every submission, in CSR form
+
+    Submission i holds values[offsets[i]:offsets[i + 1]], each item once.
+    Submissions where the key was not collected hold no items and are
+    not counted as valid.
+    """
+
+    def __init__(self, interner: Interner):
+        self.interner = interner
+        self.offsets = array("q", [0])
+        self.values = array("i")
+        self.valid = 0
+
+    def append(self, items):
+        if isinstance(items, list):
+            self.values.extend(sorted({self.interner.intern(str(item)) for item in items}))
+            self.valid += 1
+        self.offsets.append(len(self.values))
+
+    def entries(self) -> tuple:
+        """(submission, item ID) of every membership, as two sequences"""
+
+        if numpy is not None:
+            offsets = numpy.array(self.offsets, dtype=numpy.int64)
+            rows = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+            return rows, numpy.array(self.values, dtype=numpy.int64)
+        rows = [row for row in range(len(self.offsets) - 1)
+                for _ in range(self.offsets[row + 1] - self.offsets[row])]
+        return rows, self.values
+
+
+class CategoryColumn():
+    """The value of a category key for every submission, -1 where missing"""
+
+    def __init__(self, interner: Interner):
+        self.interner = interner
+        self.codes = array("i")
+        self.valid = 0
+
+    def append(self, value, missing: tuple = ()):
+        if isinstance(value, str) and value not in missing:
+            self.codes.append(self.interner.intern(value))
+            self.valid += 1
+        else:
+            self.codes.append(-1)
+
+    def as_codes(self):
+        if numpy is not None:
+            return numpy.array(self.codes, dtype=numpy.int64)
+        return self.codes
+
+    def entries(self) -> tuple:
+        if numpy is not None:
+            codes = self.as_codes()
+            rows = numpy.flatnonzero(codes >= 0)
+            return rows, codes[rows]
+        rows = [row for row, code in enumerate(self.codes) if code >= 0]
+        return rows, [self.codes[row] for row in rows]
+
+
+class Aggregator():
+    """Columns of many submissions, and the aggregates computed from them"""
+
+    # ~ Probe results that are not a category of their own
+    MISSING = ("Timed out", "Error")
+
+    def __init__(self):
+        namespaces = {namespace: Interner() for namespace in LIST_KEYS.values()}
+        self.columns = {key: MembershipColumn(namespaces[namespace])
+                        for key, namespace in LIST_KEYS.items()}
+        self.columns.update((key, CategoryColumn(Interner())) for key in CATEGORY_KEYS)
+        self.count = 0
+
+    def add(self, data: dict):
+        for key, column in self.columns.items():
+            if isinstance(column, CategoryColumn):
+                column.append(data.get(key), self.MISSING)
+            else:
+                column.append(data.get(key))
+        self.count += 1
+
+    def extend(self, submissions):
+        for data in submissions:
+            self.add(data)
+
+    def load(self, path: str):
+        """Add the submissions of a JSON lines file or a SubmissionStore
+
+        Takes the lines ingest.py writes, and the lines of
+        accumulate-collect, which wrap the data in a "data" key.
+        """
+
+        if os.path.isdir(path):
+            from .store import SubmissionStore
+            # ~ Read-only, the ingest server may be appending to it
+            store = SubmissionStore(path, readonly=True)
+            try:
+                self.extend(store.records())
+            finally:
+                store.close()
+            return
+
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    data = json.loads(line)
+                    self.add(data.get("data", data) if "Unique ID" not in data else data)
+
+    def popularity(self, key: str, top: int = None) -> list:
+        """(item, submissions holding it, share of valid submissions),
+        most common first
+        """
+
+        column = self.columns[key]
+        _rows, ids = column.entries()
+        if numpy is not None:
+            counts = numpy.bincount(ids, minlength=len(column.interner))
+            order = numpy.argsort(-counts, kind="stable")[:top]
+            ranked = [(int(id), int(counts[id])) for id in order if counts[id]]
+        else:
+            ranked = _most_common(collections.Counter(ids), top)
+        valid = max(column.valid, 1)
+        return [(column.interner[id], count, count / valid) for id, count in ranked]
+
+    def co_occurrence(self, key: str, top: int = 20) -> tuple:
+        """How often the top most common items of key appear together
+
+        @return: (items, matrix), matrix[i][j] is the number of
+                 submissions holding both items[i] and items[j]
+        """
+
+        column = self.columns[key]
+        items = [item for item, _count, _share in self.popularity(key, top)]
+        ids = [column.interner.ids[item] for item in items]
+        rows, values = column.entries()
+
+        if numpy is not None:
+            position = numpy.full(len(column.interner), -1, dtype=numpy.int64)
+            position[ids] = numpy.arange(len(ids))
+            positions = position[values]
+            kept = positions >= 0
+            # ~ Submissions x items indicator matrix, its Gram matrix
+            # ~ counts the pairs; float64 goes through BLAS and is exact
+            indicator = numpy.zeros((self.count, len(ids)))
+            indicator[rows[kept], positions[kept]] = 1
+            matrix = (indicator.T @ indicator).astype(numpy.int64).tolist()
+        else:
+            position = {id: i for i, id in enumerate(ids)}
+            held = collections.defaultdict(list)
+            for row, id in zip(rows, values):
+                if id in position:
+                    held[row].append(position[id])
+            matrix = [[0] * len(ids) for _ in ids]
+            for positions in held.values():
+                for i in positions:
+                    for j in positions:
+                        matrix[i][j] += 1
+        return items, matrix
+
+    def breakdown(self, key: str, by: str, top: int = 10) -> dict:
+        """Popularity of the items of key within every category of by
+
+        @param by: a category key, e.g. "Hardware vendor"
+        @return: category -> [(item, submissions holding it)], most
+                 common first
+        """
+
+        column = self.columns[key]
+        categories = self.columns[by]
+        if not isinstance(categories, CategoryColumn):
+            raise ValueError(f"{by} is not a category key")
+        rows, ids = column.entries()
+        n_items = len(column.interner)
+        n_categories = len(categories.interner)
+
+        if numpy is not None:
+            codes = categories.as_codes()[rows]
+            kept = codes >= 0
+            counts = numpy.bincount(
+                codes[kept] * n_items + ids[kept], minlength=n_categories * n_items,
+            ).reshape(n_categories, n_items)
+            order = numpy.argsort(-counts, axis=1, kind="stable")[:, :top]
+            return {
+                categories.interner[category]: [
+                    (column.interner[int(id)], int(counts[category, id]))
+                    for id in order[category] if counts[category, id]
+                ]
+                for category in range(n_categories)
+            }
+
+        counts = collections.defaultdict(collections.Counter)
+        for row, id in zip(rows, ids):
+            code = categories.codes[row]
+            if code >= 0:
+                counts[code][id] += 1
+        return {
+            categories.interner[category]: [
+                (column.interner[id], count)
+                for id, count in _most_common(counts[category], top)
+            ]
+            for category in range(n_categories)
+        }
+
+
+def _most_common(counter: collections.Counter, top: int = None) -> list:
+    """Like Counter.most_common(), ties broken by ID as with NumPy"""
+    return sorted(counter.items(), key=lambda item: (-item[1], item[0]))[:top]
+
+
+def _print_popularity(aggregator: Aggregator, key: str, top: int):
+    print(f"**{key}**")
+    for item, count, share in aggregator.popularity(key, top):
+        print(f"{share * 100:6.1f}% {count:>8} {item}")
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+",
+                        help="JSON lines files of submissions, or store directories")
+    parser.add_argument("--top", type=int, default=20, help="items listed per key")
+    parser.add_argument("--by", choices=CATEGORY_KEYS,
+                        help="also break installed apps down by this key")
+    args = parser.parse_args()
+
+    aggregator = Aggregator()
+    for path in args.files:
+        aggregator.load(path)
+
+    print(f"{aggregator.count} submissions, "
+          f"{'NumPy' if numpy is not None else 'no NumPy'}\n")
+    for key in aggregator.columns:
+        _print_popularity(aggregator, key, args.top)
+    if args.by:
+        for category, items in aggregator.breakdown("Installed apps", args.by, args.top).items():
+            print(f"**{category}**")
+            print(*(f"{count:>8} {item}" for item, count in items), sep="\n")
+            print()
@@ -0,0 +1,141 @@
+# bus.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from gi.repository import GLib, Gio
+
+from . import trace
+
+# ~ Probes only call methods, so skip the property cache and signal matches
+PROXY_FLAGS = (Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES
+               | Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS)
+
+
+class BusPool():
+    """D-Bus connections and proxies shared by all GCollector probes
+
+    Connections and proxies are created on first use and reused
+    afterwards. The pool is safe to use from several probe threads.
+    Every object is created under a lock of its own, so a service that
+    does not answer only holds up the probes that need that service.
+    """
+
+    def __init__(self):
+        self._objects = dict()
+        self._creating = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, factory):
+        """Return the object stored under key, creating it once with factory()"""
+
+        with self._lock:
+            if key in self._objects:
+                return self._objects[key]
+            creating = self._creating.setdefault(key, threading.Lock())
+        # ~ The pool lock is not held while factory() blocks
+        with creating:
+            with self._lock:
+                if key in self._objects:
+                    return self._objects[key]
+            value = factory()
+            with self._lock:
+                self._objects[key] = value
+                del self._creating[key]
+            return value
+
+    def shared(self, key: str, factory):
+        """Return the object stored under key, creating it with factory()
+
+        For client objects that wrap their own bus connection, such as
+        Goa.Client.
+        """
+
+        return self._get(("shared", key), factory)
+
+    def connection(self, bus_type: Gio.BusType,
+                   cancellable: Gio.Cancellable = None) -> Gio.DBusConnection:
+        def connect():
+            with trace.span("bus_get_sync", "dbus", bus=bus_type.value_nick):
+                return Gio.bus_get_sync(bus_type, cancellable)
+
+        return self._get(("connection", bus_type), connect)
+
+    def proxy(self, bus_type: Gio.BusType, name: str, path: str, interface: str,
+              cancellable: Gio.Cancellable = None) -> Gio.DBusProxy:
+        connection = self.connection(bus_type, cancellable)
+        return self._get(
+            ("proxy", bus_type, name, path, interface),
+            lambda: Gio.DBusProxy.new_sync(
+                connection, PROXY_FLAGS, None,
+                name, path, interface, cancellable,
+            ),
+        )
+
+    def call(self, bus_type: Gio.BusType, name: str, path: str, interface: str,
+             method: str, parameters: GLib.Variant = None, timeout: int = -1,
+             cancellable: Gio.Cancellable = None) -> GLib.Variant:
+        """Call a method through the pooled proxy and wait for the reply"""
+
+        proxy = self.proxy(bus_type, name, path, interface, cancellable)
+        with trace.span(f"{interface}.{method}", "dbus"):
+            return proxy.call_sync(
+                method, parameters, Gio.DBusCallFlags.NONE, timeout, cancellable,
+            )
+
+    def call_many(self, bus_type: Gio.BusType, calls: list, timeout: int = -1,
+                  cancellable: Gio.Cancellable = None) -> list:
+        """Send several method calls at once and wait for all replies
+
+        @param calls: (name, path, interface, method, parameters, reply_type)
+                      tuples
+        @return: the reply or the GLib.Error of each call, in order
+
+        All messages are written to the bus before the first reply is
+        read, so the calls cost a single round-trip.
+        """
+
+        connection = self.connection(bus_type, cancellable)
+        results = [None] * len(calls)
+        pending = len(calls)
+
+        def on_reply(conn, res, index):
+            nonlocal pending
+            try:
+                results[index] = conn.call_finish(res)
+            except GLib.Error as e:
+                results[index] = e
+            pending -= 1
+
+        # ~ Replies are dispatched to a private context, so this works
+        # ~ from probe threads without a running main loop
+        context = GLib.MainContext.new()
+        context.push_thread_default()
+        try:
+            with trace.span("call_many", "dbus", calls=len(calls)):
+                for index, (name, path, interface, method, parameters, reply_type) in enumerate(calls):
+                    connection.call(
+                        name, path, interface, method, parameters, reply_type,
+                        Gio.DBusCallFlags.NONE, timeout, cancellable,
+                        on_reply, index,
+                    )
+                while pending:
+                    context.iteration(True)
+        finally:
+            context.pop_thread_default()
+
+        return results
@@ -6,43 +6,105 @@
 #
 #  Copyright 2022 vstanek <vstanek@redhat.com>
 
-import requests
 import os
 import pwd
 import subprocess
 import re
+import shlex
+import shutil
+import configparser
 import json
 import hashlib
-
-if "gnome" not in os.environ.get("XDG_CURRENT_DESKTOP", "").lower():
-    print("This tool must be run from a GNOME desktop.")
-    from sys import exit
-    exit(1)
+import copy
+import time
+import threading
+import sys
+import argparse
+import traceback
+import importlib
+from datetime import datetime, timezone
+from collections import deque
 
 import gi
 
-gi.require_version('AccountsService', '1.0')
-from gi.repository import GLib, Gio, AccountsService
+from gi.repository import GLib, Gio
 
-try:
-    gi.require_version('Goa', '1.0')
-    from gi.repository import Goa
-    HAVE_GOA = True
-except (ValueError, ImportError):
-    HAVE_GOA = False
+from .bus import BusPool
+from .desktop import DesktopEntryScanner
+from .snapshot import SnapshotCache, file_stamp
+from .payload import Payload
+from . import trace
+from .probes import ProbeRegistry, FILE, GSETTINGS, DBUS, COSTS
 
-# Older GNOME (<41) compatibility
-try:
-    gi.require_version('Malcontent', '0')
-    from gi.repository import Malcontent
-    HAVE_MALCONTENT = True
-except (ValueError, ImportError):
-    HAVE_MALCONTENT = False
+# ~ AccountsService, Goa and Malcontent typelibs, and requests, are only
+# ~ loaded by the probe or the upload that needs them, see _typelib()
+_typelibs = dict()
+_typelibs_lock = threading.Lock()
 
 # ~ User application data directory and status file
 USER_DIR = GLib.get_user_data_dir()
 APP_DIR = os.path.join(USER_DIR, 'gnome-info-collect')
 STATUS_FILE = os.path.join(APP_DIR, 'uploaded')
+DESKTOP_INDEX_FILE = os.path.join(APP_DIR, 'desktop-index.json')
+SNAPSHOT_FILE = os.path.join(APP_DIR, 'snapshot.json')
+LAST_UPLOAD_FILE = os.path.join(APP_DIR, 'last-upload.json')
+SPOOL_DIR = os.path.join(APP_DIR, 'spool')
+
+# ~ Where Gio looks for .desktop files, highest priority first
+APPLICATIONS_DIRS = [
+    os.path.join(d, 'applications')
+    for d in [USER_DIR, *GLib.get_system_data_dirs()]
+]
+
+# ~ Where GNOME Shell looks for extensions, user extensions first
+EXTENSIONS_DIRS = [
+    os.path.join(d, 'gnome-shell', 'extensions')
+    for d in [USER_DIR, *GLib.get_system_data_dirs()]
+]
+
+# ~ Time limits in seconds for a single probe and for the whole collection
+PROBE_TIMEOUT = 5
+COLLECT_TIMEOUT = 15
+# ~ How long a cancelled probe gets to return before it is left behind
+PROBE_GRACE = 1
+
+# ~ Value stored for every key of a probe that ran out of time, or failed
+TIMED_OUT = "Timed out"
+ERROR = "Error"
+
+# ~ Where upload_data() sends to when no server is given, same default as
+# ~ the server-url key of the application's GSettings schema
+DEFAULT_SERVER = "https://gnome-info-collect-app.apps.openshift4.gnome.org"
+
+# ~ hostnamectl field -> collected data key
+HW_OS_FIELDS = {
+    "Operating System": "Operating system",
+    "Hardware Vendor": "Hardware vendor",
+    "Hardware Model": "Hardware model",
+}
+# ~ Sources for the same keys, in the order they are tried
+OS_RELEASE_FILES = ("/etc/os-release", "/usr/lib/os-release")
+HOSTNAME1_PROPERTIES = {
+    "OperatingSystemPrettyName": "Operating system",
+    "HardwareVendor": "Hardware vendor",
+    "HardwareModel": "Hardware model",
+}
+DMI_FILES = {
+    "Hardware vendor": "/sys/class/dmi/id/sys_vendor",
+    "Hardware model": "/sys/class/dmi/id/product_name",
+}
+
+# ~ sshd is called ssh.service on Debian based systems
+SSHD_UNITS = ("sshd.service", "ssh.service")
+
+# ~ Inputs of the snapshot cache invalidation keys
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+DCONF_SYSTEM_DB_DIR = "/etc/dconf/db"
+ACCOUNTS_SERVICE_USERS_DIR = "/var/lib/AccountsService/users"
+
+FLATHUB_URL = "https://dl.flathub.org/repo/"
+FLATPAK_SYSTEM_DIR = "/var/lib/flatpak"
+FLATPAK_CONFIG_DIR = "/etc/flatpak"
 
 
 class GCollector():
@@ -50,137 +112,547 @@ class GCollector():
     gnome-info-collect project.
     """
 
-    def __init__(self):
-        self.data = dict()
+    # ~ Probes register below in the order their keys appear in the data
+    registry = ProbeRegistry()
 
-    def collect_data(self) -> dict:
-        """Collects data and returns it in a dictionary"""
-
-        self._get_hw_os_info()
-        self._get_flatpak_info()
-        self._get_installed_apps()
-        self._get_favourited_apps()
-        self._get_online_accounts()
-        self._get_sharing_settings()
-        self._get_workspaces_status()
-        self._get_number_of_users()
-        self._get_default_browser()
-        self._get_enabled_extensions()
-        self._get_salted_machine_id_hash()
+    def __init__(self, timeout: float = COLLECT_TIMEOUT,
+                 probe_timeout: float = PROBE_TIMEOUT,
+                 runtime_extensions: bool = False):
+        """
+        @param runtime_extensions: ask the running Shell which extensions
+                                   are active, instead of reading the
+                                   settings it starts them from
+        """
+
+        self.data = dict()
+        self.timings = dict()
+        self.timeout = timeout
+        self.probe_timeout = probe_timeout
+        self.runtime_extensions = runtime_extensions
+        # ~ Replaced by a per-probe cancellable in _run_probe()
+        self.cancellable = None
+        self._cancellables = []
+        self._expired = threading.Event()
+        self.timed_out = set()
+        # ~ Shared by all probes, including the copies made by _run_probe()
+        self.bus = BusPool()
+
+    def collect_data(self, concurrent: bool = False, max_workers: int = None,
+                     callback=None, cache: SnapshotCache = None,
+                     probes: list = None, keys: list = None,
+                     max_cost: int = None) -> dict:
+        """Collects data and returns it in a dictionary
+
+        @param concurrent: run independent probes in parallel threads
+        @param max_workers: number of threads, defaults to one per batch
+        @param callback: called as callback(probe, data) when a probe finishes,
+                         from the thread that ran it
+        @param cache: snapshot of an earlier run, probes whose inputs did not
+                      change since are taken from it instead of being run
+        @param probes: names of the probes to run, defaults to all registered
+        @param keys: only run the probes producing these keys, the other
+                     keys of those probes are collected too
+        @param max_cost: skip probes of a higher cost class, see probes.py
+
+        Probes run cheapest first, in batches of probes sharing a resource,
+        see ProbeRegistry.schedule(), on daemon threads, also when not
+        concurrent. Probes still running after self.timeout seconds, or
+        exceeding self.probe_timeout on their own, have their keys set to
+        TIMED_OUT; a probe stuck in a call that cannot be cancelled is
+        left behind and does not keep the process from exiting.
+        """
+
+        names = self.registry.select(probes, keys, max_cost)
+        results = dict()
+        keys = dict()
+        if cache is not None:
+            for name in names:
+                keys[name] = self._input_key(name)
+                cached = cache.lookup(name, keys[name])
+                if cached is not None:
+                    results[name] = cached
+                    if callback:
+                        callback(name, cached)
+        stale = [name for name in names if name not in results]
+        batches = self.registry.schedule(stale)
+
+        results.update(self._run_batches(batches, max_workers if concurrent else 1, callback))
+
+        # ~ Merge in declaration order so key order stays deterministic
+        for name in names:
+            self.data.update(results[name])
+
+        if cache is not None:
+            for name in stale:
+                # ~ Failures are retried next time rather than served until
+                # ~ the inputs change
+                if name not in self.timed_out and ERROR not in results[name].values():
+                    cache.store(name, keys[name], results[name])
+            cache.save()
 
         return self.data
 
-    def _get_hw_os_info(self):
-        # hostnamectl --json=pretty doesn't work on older systems
-        hw_os_info = subprocess.run(
-            "hostnamectl",
-            shell=False, capture_output=True, check=True
-        ).stdout.decode()
+    def refresh(self, probes: list) -> dict:
+        """Run probes again, one after another, and merge in their keys
+
+        @return: the keys the probes produced
+        """
 
-        for i in ("Operating System", "Hardware Vendor", "Hardware Model"):
+        data = dict()
+        for name in self.registry.select(probes):
+            self.timed_out.discard(name)
+            data.update(self._run_probe(name))
+        self.data.update(data)
+        return data
+
+    def payload(self) -> Payload:
+        """Payload of the data collected so far"""
+        return Payload(dict(self.data))
+
+    def _run_batches(self, batches: list, max_workers: int, callback) -> dict:
+        """Run batches on worker threads, each taking the next batch in turn"""
+
+        if not batches:
+            return dict()
+
+        finished = dict()
+        queue = deque(batches)
+
+        def work():
+            while not self._expired.is_set():
+                try:
+                    batch = queue.popleft()
+                except IndexError:
+                    return
+                self._run_batch(batch, callback, finished)
+
+        # ~ Daemon threads, unlike a ThreadPoolExecutor's workers, are not
+        # ~ joined at exit, so a wedged service cannot hang the process
+        workers = [threading.Thread(target=work, daemon=True, name=f"probe-{i}")
+                   for i in range(min(max_workers or len(batches), len(batches)))]
+        deadline = time.monotonic() + self.timeout
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        if any(worker.is_alive() for worker in workers):
+            # ~ Out of time, give up on the stragglers and return the rest
+            self._expired.set()
+            for cancellable in self._cancellables:
+                cancellable.cancel()
+
+        results = dict(finished)
+        for batch in batches:
+            for name in batch:
+                if name not in results:
+                    results[name] = self._time_out(name, callback)
+        return results
+
+    def _run_batch(self, batch: list, callback, results: dict):
+        """Run the probes of a batch one after another into results"""
+
+        for name in batch:
+            if self._expired.is_set():
+                return
+            results[name] = self._run_probe(name, callback)
+
+    def _run_probe(self, name: str, callback=None) -> dict:
+        """Run a single probe on a shallow copy of the collector
+
+        Every probe writes into its own dictionary, so probes can run
+        concurrently without interleaving their keys in self.data. The
+        copy gets its own Gio.Cancellable, cancelled once the probe
+        exceeds probe_timeout. The probe runs on a daemon thread of its
+        own; one stuck in a call without a cancellable, such as
+        AccountsService or Gio.AppInfo, is left behind PROBE_GRACE
+        seconds later and reported as timed out.
+        """
+
+        probe = copy.copy(self)
+        probe.data = dict()
+        probe.cancellable = Gio.Cancellable()
+        self._cancellables.append(probe.cancellable)
+        timer = threading.Timer(self.probe_timeout, probe.cancellable.cancel)
+        timer.daemon = True
+
+        def run():
             try:
-                res = re.search(f"{i}: (.*)$", hw_os_info, re.MULTILINE)
-                if res is not None:
-                    self.data[i.capitalize()] = res[1]
+                with trace.span(name, "probe"):
+                    self.registry[name].func(probe)
+            except subprocess.TimeoutExpired:
+                probe.data = self._timed_out_data(name)
+            except GLib.Error as e:
+                if not (e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED)
+                        or e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.TIMED_OUT)):
+                    probe.data = self._error_data(name)
                 else:
-                    raise IndexError
-            except IndexError:
-                self.data[i.capitalize()] = "Error"
-
-    def _get_flatpak_info(self):
+                    probe.data = self._timed_out_data(name)
+            except Exception:
+                # ~ One broken probe must not take the whole collection down
+                probe.data = self._error_data(name)
+
+        thread = threading.Thread(target=run, daemon=True, name=name)
+        start = time.monotonic()
+        timer.start()
+        thread.start()
+        thread.join(self.probe_timeout + PROBE_GRACE)
+        timer.cancel()
+        self.timings[name] = time.monotonic() - start
+        if thread.is_alive():
+            probe.cancellable.cancel()
+            data = self._timed_out_data(name)
+        else:
+            data = probe.data
+
+        # ~ collect_data() already reported this probe as timed out
+        if self._expired.is_set():
+            return data
+        if callback:
+            callback(name, data)
+        return data
+
+    def _timed_out_data(self, name: str) -> dict:
+        self.timed_out.add(name)
+        return {key: TIMED_OUT for key in self.registry[name].keys}
+
+    def _error_data(self, name: str) -> dict:
+        keys = self.registry[name].keys
+        print(f"Error collecting {', '.join(keys)}:", file=sys.stderr)
+        traceback.print_exc()
+        return {key: ERROR for key in keys}
+
+    def _time_out(self, name: str, callback=None) -> dict:
+        data = self._timed_out_data(name)
+        if callback:
+            callback(name, data)
+        return data
+
+    def _input_key(self, name: str):
+        """Invalidation key for the cached result of a probe
+
+        Built from the modification times of the files the probe's result
+        depends on. None for probes whose result cannot be keyed on files,
+        those are always run. The installed apps are among them: they
+        also depend on every .desktop file, PATH and the parental
+        controls, and DesktopEntryScanner keeps its own per-file index.
+        """
+
+        user_config = GLib.get_user_config_dir()
+        dconf = [os.path.join(user_config, "dconf", "user"), DCONF_SYSTEM_DB_DIR]
+        flatpak_configs = []
+        if name == "_get_flatpak_info":
+            try:
+                flatpak_configs = [
+                    os.path.join(installation, "repo", "config")
+                    for installation in self._flatpak_installations()
+                ]
+            except (OSError, ValueError, configparser.Error):
+                return None  # The probe reports the broken configuration
+        inputs = {
+            "_get_hw_os_info": [*OS_RELEASE_FILES, "/etc/machine-info"],
+            "_get_flatpak_info": flatpak_configs,
+            "_get_favourited_apps": dconf,
+            "_get_workspaces_status": dconf,
+            "_get_number_of_users": ["/etc/passwd", ACCOUNTS_SERVICE_USERS_DIR],
+            "_get_default_browser": [
+                *_mimeapps_lists(),
+                *APPLICATIONS_DIRS,
+                *(os.path.join(d, "mimeinfo.cache") for d in APPLICATIONS_DIRS),
+            ],
+            "_get_online_accounts": [
+                os.path.join(user_config, "goa-1.0", "accounts.conf"),
+            ],
+            "_get_salted_machine_id_hash": ["/etc/machine-id"],
+        }.get(name)
+        if name == "_get_enabled_extensions" and not self.runtime_extensions:
+            inputs = [*dconf, *EXTENSIONS_DIRS]
+        if inputs is None:
+            return None
+
+        key = [[path, file_stamp(path)] for path in inputs]
+        if name == "_get_hw_os_info":
+            # ~ Hardware only changes across reboots
+            try:
+                with open(BOOT_ID_FILE) as f:
+                    key.append(f.read().strip())
+            except OSError:
+                return None
+        elif name == "_get_flatpak_info":
+            key.append(shutil.which("flatpak"))
+        elif name == "_get_default_browser":
+            key.append(os.environ.get("XDG_CURRENT_DESKTOP", ""))
+        elif name == "_get_salted_machine_id_hash":
+            key.append(os.getuid())
+        return key
+
+    def _system_bus(self) -> Gio.DBusConnection:
+        """System bus connection shared by the system bus probes"""
+        return self.bus.connection(Gio.BusType.SYSTEM, self.cancellable)
+
+    @property
+    def _dbus_timeout(self) -> int:
+        """D-Bus call timeout in milliseconds"""
+        return int(self.probe_timeout * 1000)
+
+    @registry.probe("Operating system", "Hardware vendor", "Hardware model",
+                    cost=DBUS, resource="system-bus")
+    def _get_hw_os_info(self):
+        # ~ Same sources hostnamectl reads, without spawning it
+        info = self._read_os_release()
+        info.update(self._read_hostname1(found=info))
+        info.update(self._read_dmi(found=info))
+        if len(info) < len(HW_OS_FIELDS):
+            info.update(self._read_hostnamectl(found=info))
+
+        for key in HW_OS_FIELDS.values():
+            self.data[key] = info.get(key, "Error")
+
+    def _read_os_release(self) -> dict:
+        for path in OS_RELEASE_FILES:
+            try:
+                with open(path) as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                continue
+            for line in lines:
+                name, sep, value = line.partition("=")
+                if sep and name.strip() == "PRETTY_NAME":
+                    try:
+                        value = " ".join(shlex.split(value))
+                    except ValueError:
+                        continue
+                    if value:
+                        return {"Operating system": value}
+            break  # Only the first existing file is used
+        return {}
+
+    def _read_hostname1(self, found: dict) -> dict:
+        """Fields hostname1 reports, leaving out those already in found"""
+        try:
+            bus = self._system_bus()
+            with trace.span("hostname1.GetAll", "dbus"):
+                props, = bus.call_sync(
+                    "org.freedesktop.hostname1",
+                    "/org/freedesktop/hostname1",
+                    "org.freedesktop.DBus.Properties",
+                    "GetAll",
+                    GLib.Variant("(s)", ("org.freedesktop.hostname1",)),
+                    GLib.VariantType("(a{sv})"),
+                    Gio.DBusCallFlags.NONE,
+                    self._dbus_timeout,
+                    self.cancellable,
+                ).unpack()
+        except GLib.Error as e:
+            if e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                raise
+            return {}
+
+        return {
+            key: props[prop]
+            for prop, key in HOSTNAME1_PROPERTIES.items()
+            if key not in found and props.get(prop)
+        }
+
+    def _read_dmi(self, found: dict) -> dict:
+        """Fields read from sysfs DMI files, leaving out those already in found"""
+        info = dict()
+        for key, path in DMI_FILES.items():
+            if key in found:
+                continue
+            try:
+                with open(path) as f:
+                    value = f.read().strip()
+            except OSError:
+                continue
+            if value:
+                info[key] = value
+        return info
+
+    def _read_hostnamectl(self, found: dict) -> dict:
+        """Fields parsed from hostnamectl, leaving out those already in found"""
+        # hostnamectl --json=pretty doesn't work on older systems
         try:
-            flatpak_retval = subprocess.run(
-                "flatpak", shell=False, stderr=subprocess.DEVNULL
-            ).returncode
-            flatpak_installed = False if flatpak_retval == 127 else True
-
-            if flatpak_installed:
-                self.data["Flatpak installed"] = True
-
-                # Flathub (enabled, filtered, disabled)
-                flatpak_remotes = subprocess.run(
-                    ["flatpak", "remotes", "--columns", "url,filter"],
-                    shell=False, capture_output=True
+            with trace.span("hostnamectl", "subprocess"):
+                hw_os_info = subprocess.run(
+                    "hostnamectl",
+                    shell=False, capture_output=True, check=True,
+                    timeout=self.probe_timeout
                 ).stdout.decode()
-                flathub = re.search(
-                    r'(https://dl.flathub.org/repo/)\s*(\S*)',
-                    flatpak_remotes)
-
-                if flathub:
-                    if flathub.group(2) == "-":
-                        self.data["Flathub enabled"] = True
-                    else:
-                        self.data["Flathub enabled"] = "filtered"
-                else:
-                    self.data["Flathub enabled"] = False
-            else:
-                self.data["Flatpak installed"] = False
-                self.data["Flathub enabled"] = False
-        except subprocess.CalledProcessError:
-            raise
-        except FileNotFoundError:
+        except (OSError, subprocess.CalledProcessError):
+            # ~ Missing or failing, keep what the other sources found
+            return {}
+
+        info = dict()
+        for field, key in HW_OS_FIELDS.items():
+            if key in found:
+                continue
+            res = re.search(f"{field}: (.*)$", hw_os_info, re.MULTILINE)
+            if res is not None:
+                info[key] = res[1]
+        return info
+
+    @registry.probe("Flatpak installed", "Flathub enabled", cost=FILE)
+    def _get_flatpak_info(self):
+        if shutil.which("flatpak") is None:
             self.data["Flatpak installed"] = False
             self.data["Flathub enabled"] = False
+            return
+
+        self.data["Flatpak installed"] = True
+        try:
+            remotes = self._read_flatpak_remotes()
+        except (OSError, configparser.Error):
+            self._get_flathub_status_cli()
+            return
+
+        # Flathub (enabled, filtered, disabled)
+        for url, flatpak_filter in remotes:
+            if url.startswith(FLATHUB_URL):
+                self.data["Flathub enabled"] = True if not flatpak_filter else "filtered"
+                break
+        else:
+            self.data["Flathub enabled"] = False
 
+    def _read_flatpak_remotes(self) -> list:
+        """Return (url, filter) of every enabled remote, like `flatpak remotes`
+
+        Reads the repo config of the system installations first, then the
+        user installation.
+        """
+
+        remotes = []
+        for installation in self._flatpak_installations():
+            config = configparser.ConfigParser(interpolation=None, strict=False)
+            try:
+                with open(os.path.join(installation, "repo", "config")) as f:
+                    config.read_file(f)
+            except FileNotFoundError:
+                continue  # Installation without a repo has no remotes
+
+            for section in config.sections():
+                if not section.startswith("remote "):
+                    continue
+                remote = config[section]
+                if remote.get("xa.disable", "false").strip() == "true":
+                    continue
+                remotes.append((remote.get("url", "").strip(),
+                                remote.get("xa.filter", "").strip()))
+        return remotes
+
+    def _flatpak_installations(self) -> list:
+        installations = [os.environ.get("FLATPAK_SYSTEM_DIR", FLATPAK_SYSTEM_DIR)]
+
+        # Additional system installations
+        config_dir = os.environ.get("FLATPAK_CONFIG_DIR", FLATPAK_CONFIG_DIR)
+        installations_d = os.path.join(config_dir, "installations.d")
+        try:
+            confs = sorted(f for f in os.listdir(installations_d) if f.endswith(".conf"))
+        except FileNotFoundError:
+            confs = []
+        for conf in confs:
+            config = configparser.ConfigParser(interpolation=None, strict=False)
+            with open(os.path.join(installations_d, conf)) as f:
+                config.read_file(f)
+            for section in config.sections():
+                if section.startswith("Installation ") and "Path" in config[section]:
+                    installations.append(config[section]["Path"].strip())
+
+        installations.append(os.environ.get(
+            "FLATPAK_USER_DIR", os.path.join(USER_DIR, "flatpak")
+        ))
+        return installations
+
+    def _get_flathub_status_cli(self):
+        """Fallback for repo configs that cannot be read directly"""
+
+        with trace.span("flatpak remotes", "subprocess"):
+            flatpak_remotes = subprocess.run(
+                ["flatpak", "remotes", "--columns", "url,filter"],
+                shell=False, capture_output=True,
+                timeout=self.probe_timeout
+            ).stdout.decode()
+        flathub = re.search(
+            r'(https://dl.flathub.org/repo/)\s*(\S*)',
+            flatpak_remotes)
+
+        if flathub:
+            if flathub.group(2) == "-":
+                self.data["Flathub enabled"] = True
+            else:
+                self.data["Flathub enabled"] = "filtered"
+        else:
+            self.data["Flathub enabled"] = False
+
+    @registry.probe("Installed apps", cost=DBUS, resource="applications")
     def _get_installed_apps(self):
-        if HAVE_MALCONTENT:
+        # Older GNOME (<41) compatibility
+        Malcontent = _typelib('Malcontent', '0')
+        if Malcontent is not None:
             manager = Malcontent.Manager(
-                connection=Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+                connection=self._system_bus()
             )
             try:
-                app_filter = manager.get_app_filter(
-                    os.getuid(),
-                    Malcontent.ManagerGetValueFlags.NONE,
-                    None
-                )
+                with trace.span("Malcontent.Manager.get_app_filter", "dbus"):
+                    app_filter = manager.get_app_filter(
+                        os.getuid(),
+                        Malcontent.ManagerGetValueFlags.NONE,
+                        self.cancellable
+                    )
+            except GLib.Error as e:
+                if e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                    raise
+                app_filter = None
             except Exception:
                 app_filter = None
         else:
             app_filter = None
 
         apps = []
-        for a in Gio.AppInfo.get_all():
-            if a.should_show() and (not app_filter or app_filter.is_appinfo_allowed(a)):
-                id = a.get_id()
-                if id.endswith(".desktop"):  # Remove .desktop suffix where appropriate
-                    id = id[:-len(".desktop")]
-                apps.append(id)
+        for id, path in DesktopEntryScanner(APPLICATIONS_DIRS, DESKTOP_INDEX_FILE).scan():
+            if app_filter:
+                info = Gio.DesktopAppInfo.new_from_filename(path)
+                if info is None or not app_filter.is_appinfo_allowed(info):
+                    continue
+            if id.endswith(".desktop"):  # Remove .desktop suffix where appropriate
+                id = id[:-len(".desktop")]
+            apps.append(id)
 
         self.data["Installed apps"] = apps
 
+    @registry.probe("Favourited apps", cost=GSETTINGS, resource="dconf")
     def _get_favourited_apps(self):
         favs = []
-        for f in Gio.Settings(schema_id="org.gnome.shell").get_value("favorite-apps"):
+        for f in _settings("org.gnome.shell").get_value("favorite-apps"):
             if f.endswith(".desktop"):  # Remove .desktop suffix where appropriate
                 f = f[:-len(".desktop")]
             favs.append(f)
         self.data["Favourited apps"] = favs
 
+    @registry.probe("Online accounts", cost=DBUS, resource="session-bus")
     def _get_online_accounts(self):
         accounts = []
 
-        if HAVE_GOA:
-            goa_client = Goa.Client.new_sync(None)
+        Goa = _typelib('Goa', '1.0')
+        if Goa is not None:
+            def new_client():
+                with trace.span("Goa.Client.new_sync", "dbus"):
+                    return Goa.Client.new_sync(self.cancellable)
+
+            goa_client = self.bus.shared("goa", new_client)
             acc_objects = goa_client.get_accounts()
 
             for acc in acc_objects:
                 accounts.append(acc.get_account().props.provider_name)  # or provider_type
         else:
-            goa = Gio.DBusProxy.new_for_bus_sync(
+            goa_objects, = self.bus.call(
                 Gio.BusType.SESSION,
-                Gio.DBusProxyFlags.NONE,
-                None,
                 "org.gnome.OnlineAccounts",
                 "/org/gnome/OnlineAccounts",
                 "org.freedesktop.DBus.ObjectManager",
-                None,
-            )
-            goa_objects, = goa.call_sync(
                 "GetManagedObjects",
                 None,
-                Gio.DBusCallFlags.NONE,
-                -1,
-                None,
+                self._dbus_timeout,
+                self.cancellable,
             ).unpack()
             for ifaces in goa_objects.values():
                 try:
@@ -195,12 +667,14 @@ class GCollector():
         schema = "org.gnome.settings-daemon.plugins.sharing.service"
         path_base = "/org/gnome/settings-daemon/plugins/sharing/"
 
-        setting = Gio.Settings.new_with_path(
+        setting = _settings(
             schema,
             path_base + service + "/"
         ).get_value("enabled-connections")
         return False if str(setting) == "@as []" else True
 
+    @registry.probe("File sharing", "Remote desktop", "Multimedia sharing",
+                    "Remote login", cost=DBUS, resource="system-bus")
     def _get_sharing_settings(self):
         # File sharing (DAV)
         if self._fetch_sharing_setting("gnome-user-share-webdav"):
@@ -235,16 +709,48 @@ class GCollector():
 
         # Remote login (SSH)
         try:
-            sshd_status = subprocess.run(
-                ["systemctl", "is-active", "sshd"],
-                shell=False, capture_output=True
-            ).stdout.decode().strip()
+            self.data["Remote login"] = self._get_sshd_state()
+        except GLib.Error as e:
+            if e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                raise
+            # No systemd on the system bus, ask systemctl instead
+            with trace.span("systemctl is-active", "subprocess"):
+                sshd_status = subprocess.run(
+                    ["systemctl", "is-active", "sshd"],
+                    shell=False, capture_output=True,
+                    timeout=self.probe_timeout
+                ).stdout.decode().strip()
             self.data["Remote login"] = sshd_status
-        except subprocess.CalledProcessError:
-            raise
 
+    def _get_sshd_state(self) -> str:
+        """ActiveState of sshd.service, or of ssh.service (Debian) if active"""
+
+        # Accessing the unit object makes systemd load it, so units that
+        # are not installed report "inactive" like `systemctl is-active`
+        replies = self.bus.call_many(Gio.BusType.SYSTEM, [
+            (
+                "org.freedesktop.systemd1",
+                _systemd_unit_path(unit),
+                "org.freedesktop.DBus.Properties",
+                "Get",
+                GLib.Variant("(ss)", ("org.freedesktop.systemd1.Unit", "ActiveState")),
+                GLib.VariantType("(v)"),
+            )
+            for unit in SSHD_UNITS
+        ], self._dbus_timeout, self.cancellable)
+
+        states = []
+        for reply in replies:
+            if isinstance(reply, GLib.Error):
+                raise reply
+            state, = reply.unpack()
+            states.append(state)
+        return "active" if "active" in states else states[0]
+
+    @registry.probe("Workspaces only on primary", "Workspaces dynamic",
+                    cost=GSETTINGS, resource="dconf")
     def _get_workspaces_status(self):
-        mutter_settings = Gio.Settings(schema_id="org.gnome.mutter")
+        mutter_settings = _settings("org.gnome.mutter")
 
         # Workspaces only on primary display
         workspaces_primary = mutter_settings.get_value(
@@ -258,33 +764,73 @@ class GCollector():
         )
         self.data["Workspaces dynamic"] = bool(workspaces_dynamic)
 
+    @registry.probe("Number of users", cost=DBUS, resource="system-bus")
     def _get_number_of_users(self):
-        count = len(AccountsService.UserManager.get_default().list_users())
+        AccountsService = _typelib('AccountsService', '1.0')
+        if AccountsService is None:
+            raise ImportError("AccountsService typelib is not installed")
+        with trace.span("AccountsService.UserManager.list_users", "dbus"):
+            count = len(AccountsService.UserManager.get_default().list_users())
 
         self.data["Number of users"] = count
 
+    @registry.probe("Default browser", cost=FILE, resource="applications")
     def _get_default_browser(self):
         self.data["Default browser"] = Gio.AppInfo.get_default_for_type(
             "x-scheme-handler/https", False).get_display_name()
 
+    @registry.probe("Enabled extensions", cost=GSETTINGS, resource="dconf")
     def _get_enabled_extensions(self):
+        if self.runtime_extensions:
+            self._get_running_extensions()
+            return
+
+        # ~ What GNOME Shell enables at startup, see extensionSystem.js
+        shell_settings = _settings("org.gnome.shell")
+        schema = shell_settings.props.settings_schema
+        # Older GNOME (<40) has no disabled-extensions key
+        disabled = set()
+        if schema.has_key("disabled-extensions"):
+            disabled = set(shell_settings.get_strv("disabled-extensions"))
+        user_disabled = (schema.has_key("disable-user-extensions")
+                         and shell_settings.get_boolean("disable-user-extensions"))
+
+        enabled = []
+        for uuid in shell_settings.get_strv("enabled-extensions"):
+            if uuid in disabled or uuid in enabled:
+                continue
+            path = self._find_extension(uuid)
+            if path is None:
+                continue  # Enabled but not installed
+            if user_disabled and path.startswith(EXTENSIONS_DIRS[0] + os.sep):
+                continue
+            enabled.append(uuid)
+
+        self.data["Enabled extensions"] = enabled
+
+    def _find_extension(self, uuid: str) -> str:
+        """Path of the installed extension uuid, user extensions first"""
+
+        for extensions_dir in EXTENSIONS_DIRS:
+            path = os.path.join(extensions_dir, uuid)
+            if os.path.isfile(os.path.join(path, "metadata.json")):
+                return path
+        return None
+
+    def _get_running_extensions(self):
+        """Extensions the running Shell reports as enabled"""
+
         enabled_extensions_list = []
 
-        ge = Gio.DBusProxy.new_for_bus_sync(
+        ext_objects, = self.bus.call(
             Gio.BusType.SESSION,
-            Gio.DBusProxyFlags.NONE,
-            None,
             "org.gnome.Shell",
             "/org/gnome/Shell",
             "org.gnome.Shell.Extensions",
-            None,
-        )
-        ext_objects, = ge.call_sync(
             "ListExtensions",
             None,
-            Gio.DBusCallFlags.NONE,
-            -1,
-            None,
+            self._dbus_timeout,
+            self.cancellable,
         ).unpack()
         for obj in ext_objects.values():
             try:
@@ -295,6 +841,7 @@ class GCollector():
 
         self.data["Enabled extensions"] = enabled_extensions_list
 
+    @registry.probe("Unique ID", cost=FILE)
     def _get_salted_machine_id_hash(self):
         hash = ""
         with open("/etc/machine-id") as f:
@@ -304,27 +851,134 @@ class GCollector():
         self.data["Unique ID"] = hash
 
 
-def create_status_file():
+def _mimeapps_lists() -> list:
+    """mimeapps.list files deciding default applications, see the
+    XDG MIME Applications specification
+    """
+
+    desktops = [d.lower() for d in os.environ.get("XDG_CURRENT_DESKTOP", "").split(":") if d]
+    dirs = [
+        GLib.get_user_config_dir(), *GLib.get_system_config_dirs(),
+        *APPLICATIONS_DIRS,
+    ]
+    names = [f"{desktop}-mimeapps.list" for desktop in desktops] + ["mimeapps.list"]
+    return [os.path.join(d, name) for d in dirs for name in names]
+
+
+def _typelib(namespace: str, version: str):
+    """Load a GObject introspection typelib on first use
+
+    @return: the gi.repository module, None if the typelib is not installed
+    """
+
+    with _typelibs_lock:
+        if namespace not in _typelibs:
+            try:
+                gi.require_version(namespace, version)
+                _typelibs[namespace] = importlib.import_module("gi.repository." + namespace)
+            except (ValueError, ImportError):
+                _typelibs[namespace] = None
+        return _typelibs[namespace]
+
+
+def _settings(schema_id: str, path: str = None) -> Gio.Settings:
+    """Gio.Settings for schema_id
+
+    Raises KeyError if the schema is not installed, where creating the
+    Gio.Settings would abort the process, e.g. on servers without GNOME.
+    """
+
+    source = Gio.SettingsSchemaSource.get_default()
+    if source is None or source.lookup(schema_id, True) is None:
+        raise KeyError(f"GSettings schema {schema_id} is not installed")
+    if path is not None:
+        return Gio.Settings.new_with_path(schema_id, path)
+    return Gio.Settings(schema_id=schema_id)
+
+
+def _systemd_unit_path(unit: str) -> str:
+    """D-Bus object path of a systemd unit, escaped like sd_bus_path_encode()"""
+
+    escaped = "".join(
+        c if c.isascii() and c.isalnum() and (i or not c.isdigit()) else f"_{ord(c):02x}"
+        for i, c in enumerate(unit)
+    )
+    return "/org/freedesktop/systemd1/unit/" + escaped
+
+
+def is_gnome_desktop() -> bool:
+    """Check if running in a GNOME desktop session"""
+    return "gnome" in os.environ.get("XDG_CURRENT_DESKTOP", "").lower()
+
+
+def create_status_file(payload: Payload = None):
     """Create a status file in user app dir
 
-    To prevent user from uploading the data multiple times, create
+    To prevent user from uploading the same data multiple times, create
     a status file in user's app dir. Created file is checked by
     check_already_uploaded().
+
+    @param payload: the payload just uploaded, kept as the base for
+                    delta uploads of later collections
     """
 
     if not os.path.isdir(APP_DIR):  # create app dir if doesn't exist
         os.mkdir(APP_DIR)
-    with open(STATUS_FILE, 'x') as f:
-        f.write('{"status": "successful"}\n')
+    status = {"status": "successful"}
+    if payload is not None:
+        status["digest"] = payload.content_digest
+        _write_atomic(LAST_UPLOAD_FILE, payload.bytes)
+    _write_atomic(STATUS_FILE, (json.dumps(status) + "\n").encode())
+
 
+def load_last_upload() -> Payload:
+    """Payload of the last successful upload, None if unknown"""
 
-def check_already_uploaded():
+    try:
+        with open(LAST_UPLOAD_FILE, "rb") as f:
+            return Payload(json.loads(f.read()))
+    except (OSError, ValueError):
+        return None
+
+
+def last_upload_time() -> int:
+    """Time of the last successful upload in nanoseconds, None if unknown"""
+
+    try:
+        return os.stat(LAST_UPLOAD_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def already_uploaded(payload: Payload = None) -> bool:
+    """Check if data was already successfully uploaded
+
+    @param payload: newly collected data, if given only an upload of the
+                    same content counts
+    """
+
+    if not os.path.isfile(STATUS_FILE):
+        return False
+    if payload is None:
+        return True
+    last = load_last_upload()
+    return last is not None and last.content_digest == payload.content_digest
+
+
+def check_already_uploaded(payload: Payload = None):
     """Check if status file exists (data already successfully uploaded)"""
 
-    if os.path.isfile(STATUS_FILE):
+    if already_uploaded(payload):
         print("Information was already successfuly uploaded.")
         print("Not collecting or sending any data, exiting...")
-        exit(0)
+        sys.exit(0)
+
+
+def _write_atomic(path: str, content: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
 
 
 def present_collected_data(data: dict):
@@ -342,9 +996,9 @@ def present_collected_data(data: dict):
                    'Online accounts', 'Enabled extensions'):
             # Value is an array
             print(f"**{key}**")
-            if value == '"Error"':  # Error collecting this specific data
+            if isinstance(value, str):  # Error collecting this specific data
                 print(f"Error collecting {key}")
-            if not value:  # Empty array
+            elif not value:  # Empty array
                 print("None")
             else:
                 # unpack the array and print ' around
@@ -383,23 +1037,143 @@ def get_permission() -> bool:
         return False
 
 
-def upload_data(address: str, data: dict) -> requests.Response:
+def upload_data(address: str, data) -> "requests.Response":
     """Upload collected data to address via HTTP post request
 
     @param address: HTTP address of recieving server
-    @param data: json data to send
-    @return: False if error occured, True if successful
+    @param data: Payload, or dictionary (json) with data
+    @return: response of the server
+
+    Only the changes since the payload recorded by create_status_file()
+    are sent, unless the server rejects them.
     """
 
-    print("Uploading...")
+    print("Uploading...", file=sys.stderr)
+
+    payload = data if isinstance(data, Payload) else Payload(data)
 
-    # ~ Send the data
-    r = requests.post(address, data=json.dumps(data))
+    # ~ Send the data, raises HTTPError if the last attempt was unsuccessful
+    from .upload import Uploader
+    uploader = Uploader(address)
+    try:
+        with trace.span("upload", "upload"):
+            return uploader.post(payload, base=load_last_upload())
+    finally:
+        uploader.close()
+
+
+def main(argv: list = None) -> int:
+    """Headless entry point, writes one JSON object per collection"""
+
+    all_fields = GCollector.registry.keys
+    parser = argparse.ArgumentParser(
+        prog="accumulate-collect",
+        description="Collect information for the GNOME project without a GUI, "
+                    "one JSON object per line.",
+    )
+    parser.add_argument("--fields", type=lambda v: [f.strip() for f in v.split(",") if f.strip()],
+                        help="comma separated keys to collect, see --list-fields "
+                             "(default: all)")
+    parser.add_argument("--list-fields", action="store_true",
+                        help="list the keys that can be collected and exit")
+    parser.add_argument("--output", "-o", default="-",
+                        help="file to append the JSON lines to (default: stdout)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="number of collections, 0 repeats forever (default: 1)")
+    parser.add_argument("--interval", type=float, default=60,
+                        help="seconds between the start of two collections (default: 60)")
+    parser.add_argument("--sequential", action="store_true",
+                        help="run the probes one after another")
+    parser.add_argument("--runtime-extensions", action="store_true",
+                        help="ask the running GNOME Shell which extensions are active "
+                             "instead of reading its settings")
+    parser.add_argument("--max-cost", choices=COSTS,
+                        help="skip probes more expensive than this (default: run all)")
+    parser.add_argument("--upload", action="store_true",
+                        help="upload every collection, after asking for permission")
+    parser.add_argument("--server", default=DEFAULT_SERVER,
+                        help="address to upload to (default: %(default)s)")
+    parser.add_argument("--yes", "-y", action="store_true",
+                        help="consent to uploading without asking, for unattended runs")
+    parser.add_argument("--trace", metavar="FILE",
+                        help=f"write a Chrome trace of the run to FILE, as {trace.TRACE_ENV}=FILE does")
+    args = parser.parse_args(argv)
+
+    if args.list_fields:
+        print(*all_fields, sep="\n")
+        return 0
+    try:
+        GCollector.registry.for_keys(args.fields or [])
+    except KeyError as e:
+        parser.error(f"unknown field {e}, see --list-fields")
+    max_cost = COSTS[args.max_cost] if args.max_cost else None
+    if args.upload and not args.yes and not sys.stdin.isatty():
+        parser.error("--upload needs --yes when not run from a terminal")
+    # ~ Servers expect every key, and the upload becomes the base of the
+    # ~ next delta
+    if args.upload and (args.fields or args.max_cost):
+        parser.error("--upload sends every key, it cannot be combined with "
+                     "--fields or --max-cost")
+    if args.trace:
+        trace.enable(args.trace)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "a")
+    try:
+        count = 0
+        while True:
+            start = time.monotonic()
+            collector = GCollector(runtime_extensions=args.runtime_extensions)
+            with trace.span("collect_data", keys=len(args.fields or all_fields)):
+                data = collector.collect_data(concurrent=not args.sequential,
+                                              keys=args.fields, max_cost=max_cost)
+            if args.fields:
+                data = {key: value for key, value in data.items() if key in args.fields}
+            out.write(json.dumps({
+                "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "data": data,
+            }) + "\n")
+            out.flush()
+
+            if args.upload:
+                _upload_collected(collector.payload(), args.server, args.yes)
+            trace.flush()
+
+            count += 1
+            if args.repeat and count >= args.repeat:
+                return 0
+            time.sleep(max(0, args.interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def _upload_collected(payload: Payload, server: str, consent: bool):
+    # ~ Messages go to stderr, stdout only carries the JSON lines
+    if already_uploaded(payload):
+        print("Information unchanged since the last upload, not sending.", file=sys.stderr)
+        return
+    if not consent:
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            present_collected_data(payload.data)
+            consent = get_permission()
+        finally:
+            sys.stdout = stdout
+        if not consent:
+            return
+
+    import requests
+    try:
+        r = upload_data(server, payload)
+    except requests.RequestException as e:
+        print(f"Upload failed: {e}", file=sys.stderr)
+        return
+    create_status_file(payload)
+    print(f"Status {r.status_code}: {r.text}", file=sys.stderr)
 
-    # ~ Raise HTTPError if request returned an unsuccessful status code
-    r.raise_for_status()
-    
-    return r
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,327 @@
+# dedup.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Detection of repeated submissions by Unique ID and content digest
+
+A Bloom filter over the Unique IDs answers "never seen" without touching
+the index, the common case for a new machine. Everything else is looked
+up in a persistent open-addressing hash table in a memory-mapped file,
+one fixed-size slot per Unique ID holding the digest of its latest
+submission.
+"""
+
+import os
+import math
+import mmap
+import struct
+import collections
+
+# ~ What to do with a changed submission from a known Unique ID
+REJECT = "reject"
+REPLACE = "replace"
+HISTORY = "history"
+POLICIES = (REJECT, REPLACE, HISTORY)
+
+# ~ Verdicts of DedupIndex.submit()
+NEW = "new"
+DUPLICATE = "duplicate"
+REJECTED = "rejected"
+REPLACED = "replaced"
+KEPT = "kept"
+
+MAGIC = b"ACDEDUP1"
+HEADER = struct.Struct("<8sQQ")  # Magic, capacity, used slots
+SLOT = struct.Struct("<32s32sI4x")  # Unique ID, content digest, submissions
+EMPTY = bytes(32)
+
+# ~ Slots of a new index, and the load factor at which it doubles
+CAPACITY = 1 << 16
+MAX_LOAD = 0.7
+# ~ Slots of the old table moved to the doubled one on every submit()
+GROW_STEP = 64
+GROW_SUFFIX = ".grow"
+
+# ~ False positive rate of the Bloom filter at the index capacity
+BLOOM_ERROR = 0.01
+
+
+def _probe(mm, mask: int, uid: bytes) -> tuple:
+    """(slot offset, slot) of uid, or of the empty slot it would take"""
+
+    index = int.from_bytes(uid[:8], "little") & mask
+    while True:
+        offset = HEADER.size + index * SLOT.size
+        slot = SLOT.unpack_from(mm, offset)
+        if slot[0] == uid or slot[0] == EMPTY:
+            return offset, slot
+        index = (index + 1) & mask
+
+
+class BloomFilter():
+    """Set membership with false positives, for keys that are digests
+
+    The keys are SHA-256 digests, so their bytes already are independent
+    uniform hashes; positions come from double hashing two 64 bit words.
+    """
+
+    def __init__(self, capacity: int, error: float = BLOOM_ERROR):
+        self.size = max(64, int(-capacity * math.log(error) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: bytes):
+        h1 = int.from_bytes(key[0:8], "little")
+        h2 = int.from_bytes(key[8:16], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: bytes):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+class _Table():
+    """One hash table file, mapped into memory"""
+
+    def __init__(self, path: str, capacity: int = None):
+        """
+        @param capacity: create an empty table of this many slots first
+        """
+
+        if capacity is not None:
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, capacity, 0))
+                f.truncate(HEADER.size + capacity * SLOT.size)
+        self.path = path
+        self._file = open(path, "r+b")
+        try:
+            self.map = mmap.mmap(self._file.fileno(), 0)
+        except ValueError:  # Empty file
+            self._file.close()
+            raise ValueError(f"{path} is not a dedup index")
+        magic, self.capacity, self.used = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or len(self.map) != HEADER.size + self.capacity * SLOT.size:
+            self.close()
+            raise ValueError(f"{path} is not a dedup index")
+        self.mask = self.capacity - 1
+
+    def find(self, uid: bytes) -> tuple:
+        return _probe(self.map, self.mask, uid)
+
+    def put(self, offset: int, uid: bytes, digest: bytes, count: int, new: bool):
+        SLOT.pack_into(self.map, offset, uid, digest, count)
+        if new:
+            self.used += 1
+            HEADER.pack_into(self.map, 0, MAGIC, self.capacity, self.used)
+
+    def slot(self, index: int) -> tuple:
+        return SLOT.unpack_from(self.map, HEADER.size + index * SLOT.size)
+
+    def bloom(self) -> BloomFilter:
+        """Bloom filter of the Unique IDs in the table"""
+
+        bloom = BloomFilter(self.capacity)
+        # ~ Unpacked in place, without copying the table
+        with memoryview(self.map) as view:
+            slots = view[HEADER.size:]
+            for uid, _digest, _count in SLOT.iter_unpack(slots):
+                if uid != EMPTY:
+                    bloom.add(uid)
+            slots.release()
+        return bloom
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+
+
+class DedupIndex():
+    """Latest content digest of every Unique ID, persisted in path
+
+    Lookups and inserts touch one Bloom filter and, on average, about
+    one slot. Once MAX_LOAD of the slots are used, a table twice the
+    size is started next to it, and every submit() moves GROW_STEP slots
+    over until the old one is empty, so no single call pays for copying
+    the whole table. Not thread-safe; the ingest server only uses it
+    from its event loop. Changes reach the disk on flush(), a crash
+    before loses the last changes, which then count as new submissions.
+    """
+
+    def __init__(self, path: str, policy: str = REPLACE, capacity: int = CAPACITY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}")
+        self.path = path
+        self.policy = policy
+        self.counts = collections.Counter()
+        # ~ While growing, the table being emptied, its Bloom filter and
+        # ~ the next of its slots to move
+        self._old = None
+        self._old_bloom = None
+        self._next = 0
+
+        if not os.path.exists(path):
+            _Table(path, 1 << max(4, (capacity - 1).bit_length())).close()
+        self._table = _Table(path)
+        self.bloom = self._table.bloom()
+        self._resume_grow()
+        self.used = self._table.used
+
+    def _resume_grow(self):
+        """Finish a growth the last process did not get to complete"""
+
+        grow_path = self.path + GROW_SUFFIX
+        if not os.path.exists(grow_path):
+            return
+        try:
+            table = _Table(grow_path)
+        except ValueError:
+            # ~ Torn while it was created, nothing was moved into it yet
+            os.remove(grow_path)
+            return
+        self._old, self._old_bloom = self._table, self.bloom
+        self._table, self.bloom, self._next = table, table.bloom(), 0
+        self._move(self._old.capacity)
+
+    def lookup(self, uid: str) -> str:
+        """Digest of the latest submission of uid, None if unknown"""
+
+        slot = self._locate(bytes.fromhex(uid))[0]
+        return slot[1].hex() if slot is not None else None
+
+    def _locate(self, key: bytes) -> tuple:
+        """(slot, offset) of key in the current table, or (slot, None)
+        if it still is in the old table, (None, None) if unknown
+        """
+
+        if key in self.bloom:
+            offset, slot = self._table.find(key)
+            if slot[0] == key:
+                return slot, offset
+        if self._old is not None and key in self._old_bloom:
+            _offset, slot = self._old.find(key)
+            if slot[0] == key:
+                return slot, None
+        return None, None
+
+    def submit(self, uid: str, digest: str) -> str:
+        """Record a submission as the policy says, return the verdict
+
+        @param uid: Unique ID, SHA-256 hex digest
+        @param digest: content digest of the submission, SHA-256 hex
+        @return: NEW, DUPLICATE (same content as the latest), REJECTED,
+                 REPLACED or KEPT (changed content, by policy)
+        """
+
+        key = bytes.fromhex(uid)
+        new_digest = bytes.fromhex(digest)
+
+        if key not in self.bloom and (self._old is None or key not in self._old_bloom):
+            self.counts["bloom_negative"] += 1
+            slot, offset = None, None
+        else:
+            slot, offset = self._locate(key)
+
+        if slot is None:
+            verdict = NEW
+        elif slot[1] == new_digest:
+            verdict = DUPLICATE
+        elif self.policy == REJECT:
+            verdict = REJECTED
+        else:
+            verdict = REPLACED if self.policy == REPLACE else KEPT
+        self.counts[verdict] += 1
+
+        if verdict == NEW:
+            if self._old is None and (self._table.used + 1) > self._table.capacity * MAX_LOAD:
+                self._start_grow()
+            self._insert(key, new_digest, 1)
+            self.used += 1
+        elif verdict in (REPLACED, KEPT):
+            if offset is None:
+                # ~ Only in the old table, the copy there is shadowed from now on
+                self._insert(key, new_digest, slot[2] + 1)
+            else:
+                self._table.put(offset, key, new_digest, slot[2] + 1, new=False)
+
+        if self._old is not None:
+            self._move(GROW_STEP)
+        return verdict
+
+    def _insert(self, key: bytes, digest: bytes, count: int):
+        offset, _slot = self._table.find(key)
+        self._table.put(offset, key, digest, count, new=True)
+        self.bloom.add(key)
+
+    def _start_grow(self):
+        capacity = self._table.capacity * 2
+        self._old, self._old_bloom = self._table, self.bloom
+        self._table = _Table(self.path + GROW_SUFFIX, capacity)
+        self.bloom = BloomFilter(capacity)
+        self._next = 0
+
+    def _move(self, count: int):
+        """Move the next count slots of the old table to the current one
+
+        The old table is at most MAX_LOAD full, and the current one twice
+        its size, so it cannot fill up before all slots are moved.
+        """
+
+        end = min(self._old.capacity, self._next + count)
+        for index in range(self._next, end):
+            uid, digest, submissions = self._old.slot(index)
+            if uid == EMPTY:
+                continue
+            offset, slot = self._table.find(uid)
+            # ~ Otherwise submitted again since, and updated in place
+            if slot[0] != uid:
+                self._table.put(offset, uid, digest, submissions, new=True)
+                self.bloom.add(uid)
+        self._next = end
+        if end == self._old.capacity:
+            self._finish_grow()
+
+    def _finish_grow(self):
+        self._table.flush()
+        self._old.close()
+        os.replace(self._table.path, self.path)
+        self._table.path = self.path
+        self._old = self._old_bloom = None
+
+    @property
+    def capacity(self) -> int:
+        """Slots of the current table"""
+        return self._table.capacity
+
+    def __len__(self):
+        return self.used
+
+    def flush(self):
+        self._table.flush()
+        if self._old is not None:
+            self._old.flush()
+
+    def close(self):
+        self.flush()
+        self._table.close()
+        if self._old is not None:
+            self._old.close()
@@ -0,0 +1,239 @@
+# desktop.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+from gi.repository import GLib
+
+INDEX_VERSION = 2
+
+# ~ The only [Desktop Entry] keys needed to decide if an app is listed
+KEYS = ("Type", "Hidden", "NoDisplay", "OnlyShowIn", "NotShowIn", "TryExec", "Exec")
+
+
+def parse_entry(path: str):
+    """Read the keys in KEYS from the [Desktop Entry] group of a file
+
+    @return: dict of the raw values found, None if the file is unreadable
+             or has no [Desktop Entry] group
+    """
+
+    entry = dict()
+    in_group = False
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("["):
+                    if in_group:
+                        break  # Past [Desktop Entry], nothing left to read
+                    in_group = line == "[Desktop Entry]"
+                    continue
+                if not in_group:
+                    continue
+                key, sep, value = line.partition("=")
+                key = key.strip()
+                if sep and key in KEYS:
+                    entry[key] = value.strip()
+    except OSError:
+        return None
+
+    return entry if in_group else None
+
+
+def _is_true(value: str) -> bool:
+    return value in ("true", "1")
+
+
+def _split_list(value: str) -> list:
+    return [v.replace("\0", ";") for v in value.replace("\\;", "\0").split(";") if v]
+
+
+class DesktopEntryScanner():
+    """Lists the desktop IDs Gio.AppInfo.get_all() + should_show() would
+
+    Parsed entries are kept in an on-disk index keyed by directory and
+    file mtime, so later scans only stat files and re-parse the ones
+    that changed.
+    """
+
+    def __init__(self, dirs: list, index_file: str = None,
+                 desktops: list = None):
+        """
+        @param dirs: applications directories, highest priority first
+        @param index_file: where to keep the index, None to not keep one
+        @param desktops: current desktop names, defaults to $XDG_CURRENT_DESKTOP
+        """
+
+        self.dirs = dirs
+        self.index_file = index_file
+        if desktops is None:
+            desktops = [d for d in os.environ.get("XDG_CURRENT_DESKTOP", "").split(":") if d]
+        self.desktops = desktops
+        self._index = self._load_index()
+        self._index_changed = False
+        self._seen = set()
+
+    def scan(self) -> list:
+        """Return (desktop ID, path) of every entry that should be shown"""
+
+        self._seen = set()
+        seen = set()
+        visible = []
+        for appdir in self.dirs:
+            for desktop_id, path, entry in self._scan_dir(appdir):
+                # ~ A higher priority directory masks this ID, even if
+                # ~ the entry there is hidden or invalid
+                if desktop_id in seen:
+                    continue
+                seen.add(desktop_id)
+                if entry is not None and self._should_show(entry):
+                    visible.append((desktop_id, path))
+
+        if self._index_changed:
+            self._save_index()
+        return visible
+
+    def _should_show(self, entry: dict) -> bool:
+        if entry.get("Type") != "Application":
+            return False
+        if _is_true(entry.get("Hidden", "")) or _is_true(entry.get("NoDisplay", "")):
+            return False
+        # ~ g_desktop_app_info_load_from_keyfile() drops entries whose
+        # ~ TryExec or Exec binary is not found, or whose Exec is malformed
+        try_exec = entry.get("TryExec")
+        if try_exec and GLib.find_program_in_path(try_exec) is None:
+            return False
+        if entry.get("Exec") and not self._exec_found(entry["Exec"]):
+            return False
+
+        # ~ Same rules as g_desktop_app_info_get_show_in()
+        only_show_in = _split_list(entry.get("OnlyShowIn", ""))
+        not_show_in = _split_list(entry.get("NotShowIn", ""))
+        for desktop in self.desktops:
+            if desktop in only_show_in:
+                return True
+            if desktop in not_show_in:
+                return False
+        return not only_show_in
+
+    def _exec_found(self, exec: str) -> bool:
+        try:
+            _ok, argv = GLib.shell_parse_argv(exec)
+        except GLib.Error:
+            return False
+        return GLib.find_program_in_path(argv[0]) is not None
+
+    def _scan_dir(self, appdir: str):
+        """Yield (desktop ID, path, entry) for the .desktop files under appdir"""
+
+        for subdir, names in self._walk(appdir):
+            prefix = os.path.relpath(subdir, appdir).replace(os.sep, "-")
+            prefix = "" if prefix == "." else prefix + "-"
+            for name in names:
+                path = os.path.join(subdir, name)
+                yield prefix + name, path, self._entry(path)
+
+    def _walk(self, appdir: str):
+        """Yield (directory, .desktop file names) for appdir and its subdirs
+
+        A directory listing is reused from the index while the directory
+        mtime is unchanged.
+        """
+
+        stack = [appdir]
+        while stack:
+            directory = stack.pop(0)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            self._seen.add(directory)
+
+            cached = self._index["dirs"].get(directory)
+            if cached is not None and cached["mtime"] == mtime:
+                files, subdirs = cached["files"], cached["subdirs"]
+            else:
+                files, subdirs = [], []
+                try:
+                    with os.scandir(directory) as it:
+                        for e in it:
+                            if e.is_dir():
+                                subdirs.append(e.name)
+                            elif e.name.endswith(".desktop"):
+                                files.append(e.name)
+                except OSError:
+                    continue
+                files.sort()
+                subdirs.sort()
+                self._index["dirs"][directory] = {
+                    "mtime": mtime, "files": files, "subdirs": subdirs,
+                }
+                self._index_changed = True
+
+            yield directory, files
+            stack.extend(os.path.join(directory, d) for d in subdirs)
+
+    def _entry(self, path: str):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        self._seen.add(path)
+
+        cached = self._index["files"].get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        entry = parse_entry(path)
+        self._index["files"][path] = [mtime, entry]
+        self._index_changed = True
+        return entry
+
+    def _load_index(self) -> dict:
+        if self.index_file:
+            try:
+                with open(self.index_file) as f:
+                    index = json.load(f)
+                if index.get("version") == INDEX_VERSION:
+                    return index
+            except (OSError, ValueError):
+                pass
+        return {"version": INDEX_VERSION, "dirs": dict(), "files": dict()}
+
+    def _save_index(self):
+        if not self.index_file:
+            return
+
+        # ~ Forget files and directories the scan did not come across
+        for section in ("files", "dirs"):
+            self._index[section] = {
+                path: cached for path, cached in self._index[section].items()
+                if path in self._seen
+            }
+
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp = self.index_file + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self._index, f)
+            os.replace(tmp, self.index_file)
+        except OSError:
+            pass  # The index is only an optimisation
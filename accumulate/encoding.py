@@ -0,0 +1,223 @@
+# encoding.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import zlib
+import hashlib
+import threading
+
+IDENTITY = "identity"
+GZIP = "gzip"
+ZSTD = "zstd"
+
+# ~ Request header naming the dictionary a zstd body was compressed with
+DICTIONARY_HEADER = "Accumulate-Dictionary"
+
+# ~ Strings repeated across most payloads: the data keys and common app,
+# ~ extension and provider IDs. Used as a raw content zstd dictionary,
+# ~ only append to this list, as changing it changes DICTIONARY_ID.
+DICTIONARY_STRINGS = (
+    '"Default browser":', '"Enabled extensions":', '"Favourited apps":',
+    '"File sharing":', '"Flathub enabled":', '"Flatpak installed":',
+    '"Hardware model":', '"Hardware vendor":', '"Installed apps":',
+    '"Multimedia sharing":', '"Number of users":', '"Online accounts":',
+    '"Operating system":', '"Remote desktop":', '"Remote login":',
+    '"Unique ID":', '"Workspaces dynamic":', '"Workspaces only on primary":',
+    '"inactive"', '"active"', '"filtered"', 'true', 'false',
+    "org.gnome.Nautilus", "org.gnome.Terminal", "org.gnome.Console",
+    "org.gnome.TextEditor", "org.gnome.gedit", "org.gnome.Settings",
+    "org.gnome.Software", "org.gnome.Calculator", "org.gnome.Calendar",
+    "org.gnome.Contacts", "org.gnome.Maps", "org.gnome.Weather",
+    "org.gnome.clocks", "org.gnome.Photos", "org.gnome.Music",
+    "org.gnome.Totem", "org.gnome.Evince", "org.gnome.eog", "org.gnome.Loupe",
+    "org.gnome.Epiphany", "org.gnome.Boxes", "org.gnome.Connections",
+    "org.gnome.Characters", "org.gnome.font-viewer", "org.gnome.Logs",
+    "org.gnome.DiskUtility", "org.gnome.baobab", "org.gnome.SystemMonitor",
+    "org.gnome.Screenshot", "org.gnome.Cheese", "org.gnome.Snapshot",
+    "org.gnome.FileRoller", "org.gnome.seahorse.Application",
+    "org.gnome.Extensions", "org.gnome.tweaks", "org.gnome.Tour",
+    "org.gnome.Yelp", "org.gnome.Shell.Extensions", "org.gnome.PowerStats",
+    "org.gnome.DejaDup", "org.gnome.Geary", "org.gnome.Evolution",
+    "org.gnome.Fractal", "org.gnome.Builder", "org.gnome.Lollypop",
+    "org.gnome.Rhythmbox3", "org.gnome.Shotwell", "org.gnome.World.Secrets",
+    "org.gnome.design.IconLibrary", "org.gnome.gitlab.somas.Apostrophe",
+    "gnome-system-monitor", "gnome-control-center", "gnome-language-selector",
+    "gnome-initial-setup", "gnome-printers-panel", "gnome-session-properties",
+    "firefox", "org.mozilla.firefox", "org.mozilla.Thunderbird",
+    "thunderbird", "chromium", "com.google.Chrome", "google-chrome",
+    "com.brave.Browser", "com.microsoft.Edge", "org.chromium.Chromium",
+    "com.github.tchx84.Flatseal", "com.github.johnfactotum.Foliate",
+    "com.github.rafostar.Clapper", "com.mattjakeman.ExtensionManager",
+    "com.spotify.Client", "com.discordapp.Discord", "com.slack.Slack",
+    "com.valvesoftware.Steam", "com.visualstudio.code", "code",
+    "org.libreoffice.LibreOffice", "libreoffice-writer", "libreoffice-calc",
+    "libreoffice-impress", "libreoffice-startcenter", "org.gimp.GIMP",
+    "gimp", "org.inkscape.Inkscape", "org.kde.krita", "org.blender.Blender",
+    "org.videolan.VLC", "vlc", "io.mpv.Mpv", "org.telegram.desktop",
+    "org.signal.Signal", "im.riot.Riot", "us.zoom.Zoom", "org.keepassxc.KeePassXC",
+    "org.freedesktop.IBus.Setup", "ibus-setup", "nm-connection-editor",
+    "htop", "vim", "nvim", "emacs", "yelp", "simple-scan", "system-config-printer",
+    "org.fedoraproject.MediaWriter", "software-properties-gtk", "update-manager",
+    "appindicatorsupport@rgcjonas.gmail.com", "dash-to-dock@micxgx.gmail.com",
+    "ubuntu-dock@ubuntu.com", "ubuntu-appindicators@ubuntu.com",
+    "ding@rastersoft.com", "dash-to-panel@jderose9.github.com",
+    "gsconnect@andyholmes.github.io", "blur-my-shell@aunetx",
+    "user-theme@gnome-shell-extensions.gcampax.github.com",
+    "apps-menu@gnome-shell-extensions.gcampax.github.com",
+    "places-menu@gnome-shell-extensions.gcampax.github.com",
+    "launch-new-instance@gnome-shell-extensions.gcampax.github.com",
+    "window-list@gnome-shell-extensions.gcampax.github.com",
+    "background-logo@fedorahosted.org", "clipboard-indicator@tudmotu.com",
+    "caffeine@patapon.info", "Vitals@CoreCoding.com",
+    "Google", "Microsoft", "Nextcloud", "Microsoft Exchange", "IMAP and SMTP",
+    "Fedora", "Ubuntu", "Kerberos", "Firefox", "Google Chrome", "Chromium",
+    "Dell Inc.", "LENOVO", "Lenovo", "HP", "ASUSTeK COMPUTER INC.",
+    "Acer", "Micro-Star International Co., Ltd.", "Framework", "Apple Inc.",
+    "QEMU", "innotek GmbH", "VMware, Inc.", "To Be Filled By O.E.M.",
+    "Fedora Linux", "Arch Linux", "Debian GNU/Linux", "openSUSE",
+    "Pop!_OS", "Manjaro Linux", "Linux Mint", "(Workstation Edition)", " LTS",
+)
+
+DICTIONARY = "\n".join(DICTIONARY_STRINGS).encode()
+DICTIONARY_ID = hashlib.sha256(DICTIONARY).hexdigest()[:16]
+
+# ~ Set by _zstd() on first use, False once zstandard failed to import
+_zstandard = None
+_zstd_dict = None
+_zstd_lock = threading.Lock()
+
+
+class UnsupportedEncoding(ValueError):
+    """Raised for a Content-Encoding, or zstd dictionary, that is not known"""
+
+
+class TooLarge(ValueError):
+    """Raised by decode() for a body that decompresses beyond max_size"""
+
+
+def available() -> list:
+    """Content encodings this installation can produce, preferred first"""
+    return ([ZSTD] if _zstd() else []) + [GZIP, IDENTITY]
+
+
+def _zstd():
+    """Import zstandard on first use
+
+    payload.py, and with it this module, is imported at startup, long
+    before anything is compressed.
+
+    @return: the zstandard module, None if it is not installed
+    """
+
+    global _zstandard, _zstd_dict
+    with _zstd_lock:
+        if _zstandard is None:
+            try:
+                import zstandard
+            except ImportError:
+                _zstandard = False
+            else:
+                _zstd_dict = zstandard.ZstdCompressionDict(
+                    DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+                )
+                _zstandard = zstandard
+        return _zstandard or None
+
+
+def headers(content_encoding: str) -> dict:
+    """Request headers describing a body compressed with content_encoding"""
+
+    if content_encoding == IDENTITY:
+        return dict()
+    if content_encoding == ZSTD:
+        return {"Content-Encoding": ZSTD, DICTIONARY_HEADER: DICTIONARY_ID}
+    return {"Content-Encoding": content_encoding}
+
+
+def encode(body: bytes, content_encoding: str) -> bytes:
+    if content_encoding == IDENTITY:
+        return body
+    if content_encoding == GZIP:
+        # ~ mtime=0 keeps the output identical for identical input
+        return gzip.compress(body, compresslevel=6, mtime=0)
+    if content_encoding == ZSTD and _zstd():
+        return _zstandard.ZstdCompressor(level=3, dict_data=_zstd_dict).compress(body)
+    raise UnsupportedEncoding(content_encoding)
+
+
+def decode(body: bytes, content_encoding: str = None, dictionary: str = None,
+           max_size: int = None) -> bytes:
+    """Undo encode()
+
+    @param content_encoding: value of the Content-Encoding header, if any
+    @param dictionary: value of the DICTIONARY_HEADER header, if any
+    @param max_size: largest decoded size accepted, in bytes
+    @raise UnsupportedEncoding: the body cannot be decoded here
+    @raise TooLarge: the body decodes to more than max_size bytes
+    @raise ValueError: the body is corrupt
+    """
+
+    content_encoding = (content_encoding or IDENTITY).strip().lower()
+    if content_encoding == IDENTITY:
+        decoded = body
+    elif content_encoding == GZIP:
+        decoded = _gzip_decompress(body, max_size)
+    elif content_encoding == ZSTD and _zstd():
+        if dictionary is not None and dictionary != DICTIONARY_ID:
+            raise UnsupportedEncoding(f"{ZSTD} dictionary {dictionary}")
+        decoded = _zstd_decompress(body, _zstd_dict if dictionary else None, max_size)
+    else:
+        raise UnsupportedEncoding(content_encoding)
+    if max_size is not None and len(decoded) > max_size:
+        raise TooLarge(f"Decoded body larger than {max_size} bytes")
+    return decoded
+
+
+def _gzip_decompress(body: bytes, max_size: int = None) -> bytes:
+    """One gzip member, decompressed up to one byte past max_size"""
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        if max_size is None:
+            decoded = decompressor.decompress(body)
+        else:
+            decoded = decompressor.decompress(body, max_size + 1)
+            if decompressor.unconsumed_tail:
+                raise TooLarge(f"Decoded body larger than {max_size} bytes")
+    except zlib.error as e:
+        raise ValueError(f"Corrupt {GZIP} body: {e}")
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError(f"Corrupt {GZIP} body: truncated or trailing data")
+    return decoded
+
+
+def _zstd_decompress(body: bytes, dict_data, max_size: int = None) -> bytes:
+    """Streamed, so a frame header claiming a huge size allocates nothing"""
+
+    limit = float("inf") if max_size is None else max_size + 1
+    chunks, size = [], 0
+    try:
+        with _zstandard.ZstdDecompressor(dict_data=dict_data).stream_reader(body) as reader:
+            while size < limit:
+                chunk = reader.read(min(1 << 20, limit - size))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+    except _zstandard.ZstdError as e:
+        raise ValueError(f"Corrupt {ZSTD} body: {e}")
+    return b"".join(chunks)
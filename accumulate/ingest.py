@@ -0,0 +1,579 @@
+# ingest.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local collection server for the payloads upload_data() sends
+
+Accepts full and delta payloads in every content encoding the client
+can produce, checks them against the keys GCollector emits, replies
+right away and writes accepted submissions in batches in the background.
+Every reply advertises the accepted encodings and delta payloads, which
+the client asks for with OPTIONS before uploading. GET /stats reports
+request rate, latency and per-encoding sizes.
+Run with: python3 -m accumulate.ingest [--port PORT] [--store DIR]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import ipaddress
+import threading
+import collections
+from http import HTTPStatus
+
+from . import dedup, encoding
+from .payload import DELTA_CONTENT_TYPE, UNORDERED_KEYS, apply_delta, canonical_digest
+
+# ~ Limits on a single request, in bytes
+MAX_HEAD = 64 * 1024
+MAX_BODY = 16 * 1024 * 1024
+
+# ~ Seconds an idle keep-alive connection is kept open
+IDLE_TIMEOUT = 30
+
+# ~ Accepted submissions waiting to be written; when full, requests get
+# ~ 503 and the client retries them later
+QUEUE_SIZE = 10000
+# ~ Most submissions written at once
+BATCH_SIZE = 512
+
+# ~ Latencies kept for the percentiles, and seconds the rate is averaged over
+LATENCY_SAMPLES = 4096
+RATE_WINDOW = 10
+
+# ~ Keys GCollector.collect_data() emits and the types of their values,
+# ~ see the probe registry in client.py. Any key may also hold the
+# ~ "Timed out" or "Error" string instead.
+SCHEMA = {
+    "Operating system": str,
+    "Hardware vendor": str,
+    "Hardware model": str,
+    "Flatpak installed": bool,
+    "Flathub enabled": (bool, str),
+    "Installed apps": list,
+    "Favourited apps": list,
+    "Online accounts": list,
+    "File sharing": str,
+    "Remote desktop": str,
+    "Multimedia sharing": str,
+    "Remote login": str,
+    "Workspaces only on primary": bool,
+    "Workspaces dynamic": bool,
+    "Number of users": int,
+    "Default browser": str,
+    "Enabled extensions": list,
+    "Unique ID": str,
+}
+
+UNIQUE_ID = re.compile(r"[0-9a-f]{64}\Z")
+
+
+class SchemaError(ValueError):
+    """Raised by validate() for data GCollector would not have sent"""
+
+
+def validate(data):
+    """Check data has exactly the keys of SCHEMA, with values of its types
+
+    @raise SchemaError: naming the first problem found
+    """
+
+    if not isinstance(data, dict):
+        raise SchemaError("Payload is not an object")
+    missing = SCHEMA.keys() - data.keys()
+    if missing:
+        raise SchemaError(f"Missing keys: {', '.join(sorted(missing))}")
+    unknown = data.keys() - SCHEMA.keys()
+    if unknown:
+        raise SchemaError(f"Unknown keys: {', '.join(sorted(unknown))}")
+
+    for key, kind in SCHEMA.items():
+        value = data[key]
+        if isinstance(value, str) and kind is not str:
+            continue  # Timed out or error marker
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            raise SchemaError(f"{key}: unexpected {type(value).__name__}")
+        if kind is list and not all(isinstance(v, str) for v in value):
+            raise SchemaError(f"{key}: not a list of strings")
+    if not UNIQUE_ID.match(data["Unique ID"]):
+        raise SchemaError("Unique ID: not a SHA-256 hex digest")
+
+
+def validate_delta(delta):
+    """Check delta has the shape DeltaPayload gives it
+
+    @raise SchemaError: naming the first problem found
+    """
+
+    if not isinstance(delta, dict):
+        raise SchemaError("Delta is not an object")
+    for key in ("Unique ID", "Base", "Digest"):
+        if not isinstance(delta.get(key), str):
+            raise SchemaError(f"{key}: missing or not a string")
+    for key in ("Added", "Removed"):
+        lists = delta.get(key, {})
+        if not isinstance(lists, dict):
+            raise SchemaError(f"{key}: not an object")
+        for name, items in lists.items():
+            if name not in UNORDERED_KEYS:
+                raise SchemaError(f"{key}: {name} is not a list key")
+            if not isinstance(items, list) or not all(isinstance(v, str) for v in items):
+                raise SchemaError(f"{key}: {name} is not a list of strings")
+    if not isinstance(delta.get("Changed", {}), dict):
+        raise SchemaError("Changed: not an object")
+    deleted = delta.get("Deleted", [])
+    if not isinstance(deleted, list) or not all(isinstance(v, str) for v in deleted):
+        raise SchemaError("Deleted: not a list of strings")
+
+
+class IngestStats():
+    """Request counters, latencies and totals per content encoding
+
+    Only used from the event loop thread, so it needs no locking.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.status = collections.Counter()
+        self.encodings = dict()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        # ~ [second, requests] for the last RATE_WINDOW seconds
+        self._rate = collections.deque()
+        self.batches = 0
+        self.stored = 0
+        self.write_errors = 0
+
+    def request(self, status: int, seconds: float):
+        self.requests += 1
+        self.status[status] += 1
+        self.latencies.append(seconds)
+
+        second = int(time.monotonic())
+        if self._rate and self._rate[-1][0] == second:
+            self._rate[-1][1] += 1
+        else:
+            self._rate.append([second, 1])
+        while self._rate[0][0] <= second - RATE_WINDOW:
+            self._rate.popleft()
+
+    def decoded(self, content_encoding: str, wire: int, decoded: int, seconds: float):
+        stats = self.encodings.setdefault(content_encoding, {
+            "requests": 0, "wire_bytes": 0, "decoded_bytes": 0, "decode_seconds": 0.0,
+        })
+        stats["requests"] += 1
+        stats["wire_bytes"] += wire
+        stats["decoded_bytes"] += decoded
+        stats["decode_seconds"] += seconds
+
+    def written(self, count: int):
+        self.batches += 1
+        self.stored += count
+
+    def as_dict(self, queued: int = 0) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+
+        window = min(RATE_WINDOW, max(1, time.monotonic() - self.started))
+        return {
+            "requests": self.requests,
+            "status": {str(k): v for k, v in sorted(self.status.items())},
+            "rate_per_second": round(sum(n for _, n in self._rate) / window, 1),
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95),
+                           "p99": percentile(0.99)},
+            "encodings": json.loads(json.dumps(self.encodings)),
+            "queued": queued,
+            "batches": self.batches,
+            "stored": self.stored,
+            "write_errors": self.write_errors,
+        }
+
+
+class JsonLinesStorage():
+    """Appends submissions to a file, one JSON object per line"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "ab")
+
+    def append(self, records: list):
+        self._file.write(b"".join(
+            json.dumps(record, ensure_ascii=False).encode() + b"\n" for record in records
+        ))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class IngestServer():
+    """HTTP/1.1 server keeping the latest submission per Unique ID
+
+    Only listens on loopback addresses. Accepted submissions are kept in
+    memory as the base for deltas, and handed to storage in batches by a
+    background task, so replies never wait for the disk.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080, storage=None,
+                 dedup=None):
+        """
+        @param storage: object with append(records) and close(), called
+                        from a worker thread; None to only keep the
+                        latest submissions in memory
+        @param dedup: DedupIndex deciding what to do with submissions of
+                      known machines, None to store every submission
+        """
+
+        if not _is_loopback(host):
+            raise ValueError(f"{host} is not a loopback address")
+        self.host = host
+        self.port = port
+        self.storage = storage
+        self.dedup = dedup
+        self.stats = IngestStats()
+        self.latest = dict()
+        self._server = None
+        self._queue = None
+        self._writer = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(QUEUE_SIZE)
+        self._writer = asyncio.create_task(self._write_batches())
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port, limit=MAX_HEAD,
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop accepting requests and write what is still queued"""
+
+        self._server.close()
+        await self._server.wait_closed()
+        await self._queue.put(None)
+        await self._writer
+        if self.storage is not None:
+            self.storage.close()
+        if self.dedup is not None:
+            self.dedup.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._reply(writer, 431, {"error": "Request head too large"}, False)
+                    break
+
+                start = time.perf_counter()
+                status, body, keep_alive = await self._respond(reader, head)
+                await self._reply(writer, status, body, keep_alive)
+                self.stats.request(status, time.perf_counter() - start)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, reader: asyncio.StreamReader, head: bytes) -> tuple:
+        """Read the body of a request and handle it
+
+        @return: (status, reply body, keep connection alive)
+        """
+
+        try:
+            request_line, *lines = head[:-4].decode("latin-1").split("\r\n")
+            method, path, version = request_line.split(" ", 2)
+            headers = dict()
+            for line in lines:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return 400, {"error": "Malformed request"}, False
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        if "transfer-encoding" in headers:
+            return 501, {"error": "Only Content-Length bodies are supported"}, False
+        if length > MAX_BODY:
+            return 413, {"error": "Payload too large"}, False
+        try:
+            body = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return 400, {"error": "Truncated body"}, False
+
+        if method == "POST":
+            return (*self._post(headers, body), keep_alive)
+        if method == "OPTIONS":
+            # ~ What is accepted is in the headers of every reply
+            return 200, {}, keep_alive
+        if method == "GET" and path == "/stats":
+            stats = self.stats.as_dict(self._queue.qsize())
+            if self.dedup is not None:
+                stats["dedup"] = dict(self.dedup.counts, machines=len(self.dedup))
+            return 200, stats, keep_alive
+        return 404, {"error": "Not found"}, keep_alive
+
+    def _post(self, headers: dict, body: bytes) -> tuple:
+        content_encoding = headers.get("content-encoding", encoding.IDENTITY)
+
+        start = time.perf_counter()
+        try:
+            decoded = encoding.decode(body, content_encoding,
+                                      headers.get(encoding.DICTIONARY_HEADER.lower()),
+                                      max_size=MAX_BODY)
+            data = json.loads(decoded)
+        except encoding.UnsupportedEncoding as e:
+            return 415, {"error": f"Unsupported encoding: {e}"}
+        except encoding.TooLarge:
+            return 413, {"error": "Payload too large"}
+        except (OSError, ValueError) as e:
+            return 400, {"error": str(e)}
+        self.stats.decoded(content_encoding, len(body), len(decoded),
+                           time.perf_counter() - start)
+
+        if headers.get("content-type") == DELTA_CONTENT_TYPE:
+            try:
+                validate_delta(data)
+            except SchemaError as e:
+                return 422, {"error": str(e)}
+            data = self.apply_delta(data)
+            if data is None:
+                return 409, {"error": "Unknown delta base"}
+        try:
+            validate(data)
+        except SchemaError as e:
+            return 422, {"error": str(e)}
+
+        # ~ Checked before the dedup index records the submission
+        if self._queue.full():
+            return 503, {"error": "Busy, try again later"}
+        if self.dedup is not None:
+            verdict = self.dedup.submit(data["Unique ID"], canonical_digest(data))
+            if verdict == dedup.DUPLICATE:
+                return 200, {"status": "duplicate"}
+            if verdict == dedup.REJECTED:
+                return 409, {"error": "Already submitted"}
+
+        self._queue.put_nowait(data)
+        self.store(data)
+        return 200, {"status": "ok"}
+
+    async def _reply(self, writer: asyncio.StreamWriter, status: int, body: dict,
+                     keep_alive: bool):
+        content = json.dumps(body).encode()
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(content)}\r\n"
+                f"Accept-Encoding: {', '.join(encoding.available())}\r\n"
+                f"Accept-Post: application/json, {DELTA_CONTENT_TYPE}\r\n")
+        if not keep_alive:
+            head += "Connection: close\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + content)
+        await writer.drain()
+
+    async def _write_batches(self):
+        """Hand queued submissions to storage, as many at once as are waiting
+
+        While one batch is written, the next one builds up in the queue.
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            records = [record for record in batch if record is not None]
+
+            if records and self.storage is not None:
+                try:
+                    await loop.run_in_executor(None, self.storage.append, records)
+                except Exception as e:
+                    self.stats.write_errors += 1
+                    print(f"Writing {len(records)} submissions failed: {e}", file=sys.stderr)
+                    records = []
+            if records:
+                self.stats.written(len(records))
+            if self.dedup is not None:
+                self.dedup.flush()
+            if None in batch:
+                return
+
+    def store(self, data: dict):
+        self.latest[data.get("Unique ID")] = data
+
+    def apply_delta(self, delta: dict):
+        """New submission data, None if the delta does not apply"""
+
+        base = self.latest.get(delta.get("Unique ID"))
+        if base is None or canonical_digest(base) != delta.get("Base"):
+            return None
+        # ~ Items can only be added to and removed from lists
+        if any(not isinstance(base.get(key, []), list)
+               for key in (*delta.get("Added", {}), *delta.get("Removed", {}))):
+            return None
+        data = apply_delta(base, delta)
+        if canonical_digest(data) != delta.get("Digest"):
+            return None
+        return data
+
+
+async def _serve(server: IngestServer):
+    await server.start()
+    print(f"Listening on http://{server.host}:{server.port}/, "
+          f"encodings: {', '.join(encoding.available())}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8080, output: str = None,
+          store: str = None, dedup_index: str = None, policy: str = dedup.REPLACE):
+    """
+    @param output: JSON lines file to append submissions to
+    @param store: directory of a SubmissionStore to append them to,
+                  compacted every hour unless policy keeps history
+    @param dedup_index: file of the DedupIndex, None to not detect
+                        resubmissions
+    @param policy: what to do with changed submissions of known machines
+    """
+
+    storage = None
+    if store:
+        from .store import SubmissionStore
+        storage = SubmissionStore(store)
+        if dedup_index is None or policy != dedup.HISTORY:
+            storage.start_compactor()
+    elif output:
+        storage = JsonLinesStorage(output)
+
+    index = dedup.DedupIndex(dedup_index, policy) if dedup_index else None
+    server = IngestServer(host, port, storage, index)
+    try:
+        asyncio.run(_serve(server))
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.as_dict(), indent=2))
+
+
+def sample_submission(index: int) -> dict:
+    """Made up submission of machine index, valid against SCHEMA"""
+
+    rand = random.Random(index)
+    return {
+        "Operating system": rand.choice(["Fedora Linux 37 (Workstation Edition)",
+                                         "Ubuntu 22.04.1 LTS", "Arch Linux"]),
+        "Hardware vendor": rand.choice(["Lenovo", "Dell Inc.", "Framework"]),
+        "Hardware model": f"Model {rand.randrange(20)}",
+        "Flatpak installed": True,
+        "Flathub enabled": rand.choice([True, False, "filtered"]),
+        "Installed apps": sorted(f"org.example.App{i}" for i in rand.sample(range(500), 120)),
+        "Favourited apps": [f"org.example.App{i}" for i in rand.sample(range(500), 6)],
+        "Online accounts": rand.sample(["Google", "Nextcloud", "Microsoft"], rand.randrange(3)),
+        "File sharing": "inactive",
+        "Remote desktop": "inactive",
+        "Multimedia sharing": "inactive",
+        "Remote login": rand.choice(["active", "inactive"]),
+        "Workspaces only on primary": True,
+        "Workspaces dynamic": True,
+        "Number of users": rand.randrange(1, 4),
+        "Default browser": rand.choice(["Firefox", "Chromium", "Web"]),
+        "Enabled extensions": [f"ext{i}@example.org" for i in rand.sample(range(50), 4)],
+        "Unique ID": hashlib.sha256(str(index).encode()).hexdigest(),
+    }
+
+
+def bench(count: int, clients: int):
+    """Post count sample submissions through Uploader, end to end"""
+
+    from .upload import Uploader
+    from .payload import Payload
+
+    loop = asyncio.new_event_loop()
+    server = IngestServer("127.0.0.1", 0)
+    loop.run_until_complete(server.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    payloads = [Payload(sample_submission(i)) for i in range(count)]
+
+    def post_all(chunk):
+        uploader = Uploader(f"http://127.0.0.1:{server.port}/", retries=0)
+        try:
+            for payload in chunk:
+                uploader.post(payload)
+        finally:
+            uploader.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=post_all, args=(payloads[i::clients],))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    stats = server.stats.as_dict()
+    print(f"{count} submissions from {clients} clients in {seconds:.2f} s, "
+          f"{count / seconds:.0f}/s, latency p50 {stats['latency_ms']['p50']} ms "
+          f"p99 {stats['latency_ms']['p99']} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1", help="loopback address to listen on")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--output", help="file to append accepted submissions to, as JSON lines")
+    parser.add_argument("--store", help="directory to keep accepted submissions in, "
+                                        "see store.py")
+    parser.add_argument("--dedup", metavar="FILE",
+                        help="index of known machines, to detect resubmissions")
+    parser.add_argument("--policy", choices=dedup.POLICIES, default=dedup.REPLACE,
+                        help="for changed submissions of known machines (default: %(default)s)")
+    parser.add_argument("--bench", type=int, metavar="COUNT",
+                        help="post COUNT sample submissions to a private server and exit")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="concurrent uploaders for --bench (default: %(default)s)")
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.bench, args.clients)
+    elif not _is_loopback(args.host):
+        parser.error(f"{args.host} is not a loopback address")
+    else:
+        serve(args.host, args.port, args.output, args.store, args.dedup, args.policy)
@@ -15,6 +15,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
+import resource
+import threading
+
+import gi
+
+gi.require_version('Gtk', '4.0')
+gi.require_version('Adw', '1')
+
+from gi.repository import Gtk, Gio, GLib, Adw
+
 from .constants import (
     rootdir,
     app_id,
@@ -25,18 +37,22 @@ from .constants import (
     project_url,
 )
 from .window import AccumulateWindow
-from gi.repository import Gtk, Gio, Adw
-import sys
-import gi
-import json
-import os
-
-from .client import GCollector, STATUS_FILE, upload_data, create_status_file
-import requests
-import json
+from .client import (
+    GCollector,
+    SNAPSHOT_FILE,
+    SPOOL_DIR,
+    already_uploaded,
+    create_status_file,
+    is_gnome_desktop,
+    last_upload_time,
+    load_last_upload,
+)
+from .snapshot import SnapshotCache
+from . import trace
 
-gi.require_version('Gtk', '4.0')
-gi.require_version('Adw', '1')
+# ~ When set, print startup measurements once the first frame is drawn
+# ~ and quit, see build-aux/startup-budget.py
+STARTUP_PROBE = "ACCUMULATE_STARTUP_PROBE" in os.environ
 
 
 class AccumulateApplication(Adw.Application):
@@ -48,11 +64,16 @@ class AccumulateApplication(Adw.Application):
         super().__init__(application_id=app_id,
                          flags=Gio.ApplicationFlags.FLAGS_NONE)
         self.server = self.settings.get_string("server-url")
+        # ~ Created once data is collected, so requests loads after startup
+        self.spool = None
+        self.flusher = None
+        self.monitor = None
         
         self.create_action('quit', self.quit, ['<primary>q'])
         self.create_action('about', self.show_about_window)
         self.create_action('preferences', self.on_preferences_action)
         self.create_action('send', self.on_send_action)
+        self.create_action('cancel-send', self.on_cancel_send_action)
 
     def on_send_action(self, widget, _):
         print('app.send action activated')
@@ -75,42 +96,80 @@ class AccumulateApplication(Adw.Application):
 
     def send_data(self, _unused, response):
         if response == "send":
-            try:
-                r = requests.post(self.server, data=json.dumps(self.data))
-                # ~ Raise HTTPError if request returned an unsuccessful status code
-                r.raise_for_status()
-            except requests.HTTPError:
-                self.win.error.set_title(f"{r.status_code}: An HTTP error occured")
-                self.win.error.set_description(f"Server message: {str(r.text)}")
-                self.win.error_label.set_label(str(r.content))
-                self.win.error_content.set_visible(True)
-                self.win.view_stack.set_visible_child(self.win.error_stack)
-            except requests.ConnectionError:
-                self.win.error.set_title("Error connecting to the server")
-                self.win.error.set_description("Please check your internet connection and try again")
-                self.win.view_stack.set_visible_child(self.win.error_stack)
-            except requests.Timeout:
-                self.win.error.set_title("Request timed out")
-                self.win.error.set_description("Please check your internet connection and try again")
-                self.win.view_stack.set_visible_child(self.win.error_stack)
-            except Exception:
-                self.win.error.set_title("Unknown error")
-                self.win.error.set_description("Sending data unsuccessful, please, try again")
-                self.win.view_stack.set_visible_child(self.win.error_stack)
-            else:
-                # ~ No errors, print server output
-                print(f"Status {r.status_code}: {r.text}")
-                # ~ Prevent user from double-sending
-                create_status_file()
-                self.win.view_stack.set_visible_child(self.win.success)
+            from .upload import Uploader
+            self.win.sending_status.set_description("")
+            self.win.view_stack.set_visible_child(self.win.sending)
+            self.uploader = Uploader(self.server)
+            # ~ The monitor may replace self.payload while this is in flight
+            payload = self.payload
+            self.uploader.post_async(
+                payload,
+                base=load_last_upload(),
+                on_done=lambda r, error: GLib.idle_add(self.on_data_sent, payload, r, error),
+                on_progress=lambda *args: GLib.idle_add(self.on_send_progress, *args),
+            )
+
+    def on_send_progress(self, attempt, attempts, delay):
+        if attempt > 1:
+            self.win.sending_status.set_description(
+                f"Retrying in {delay:.1f} s (attempt {attempt} of {attempts})"
+            )
+
+    def on_cancel_send_action(self, widget, _):
+        self.uploader.cancel()
+
+    def on_data_sent(self, payload, r, error):
+        import requests
+        from .upload import UploadCancelled
+
+        self.uploader.close()
+        trace.flush()
+        try:
+            if error is not None:
+                raise error
+        except UploadCancelled:
+            self.win.bottom_bar.show()
+            self.win.view_stack.set_visible_child(self.win.main)
+        except requests.HTTPError as e:
+            r = e.response
+            self.win.error.set_title(f"{r.status_code}: An HTTP error occured")
+            self.win.error.set_description(f"Server message: {str(r.text)}")
+            self.win.error_label.set_label(str(r.content))
+            self.win.error_content.set_visible(True)
+            self.win.view_stack.set_visible_child(self.win.error_stack)
+        except requests.ConnectionError:
+            self.spool.put(payload)
+            self.win.error.set_title("Error connecting to the server")
+            self.win.error.set_description("The information will be sent automatically once you are back online")
+            self.win.view_stack.set_visible_child(self.win.error_stack)
+        except requests.Timeout:
+            self.spool.put(payload)
+            self.win.error.set_title("Request timed out")
+            self.win.error.set_description("The information will be sent automatically once you are back online")
+            self.win.view_stack.set_visible_child(self.win.error_stack)
+        except Exception:
+            self.win.error.set_title("Unknown error")
+            self.win.error.set_description("Sending data unsuccessful, please, try again")
+            self.win.view_stack.set_visible_child(self.win.error_stack)
+        else:
+            # ~ No errors, print server output
+            print(f"Status {r.status_code}: {r.text}")
+            # ~ Prevent user from double-sending, and send deltas from now on
+            create_status_file(payload)
+            self.win.view_stack.set_visible_child(self.win.success)
+
     def do_activate(self):
         """Called when the application is activated.
 
         We raise the application's main window, creating it if
-        necessary.
+        necessary, and start collecting data in the background.
         """
         self.win: AccumulateWindow = self.props.active_window
-        if not self.win:
+        if self.win:
+            self.win.present()
+            return
+
+        with trace.span("create window", "ui"):
             self.win = AccumulateWindow(application=self,
                                    default_height=self.settings.get_int(
                                        "window-height"),
@@ -119,66 +178,91 @@ class AccumulateApplication(Adw.Application):
                                    fullscreened=self.settings.get_boolean(
                                        "window-fullscreen"),
                                    maximized=self.settings.get_boolean("window-maximized"),)
-        self.win.present()
-        
-        if os.path.isfile(STATUS_FILE):
+            self.win.show_placeholders()
+        with trace.span("present", "ui"):
+            self.win.present()
+
+        # ~ Sending is only possible once every probe has reported back
+        self.lookup_action("send").set_enabled(False)
+        threading.Thread(target=self.collect_data, daemon=True).start()
+
+        if STARTUP_PROBE or trace.enabled():
+            self.win.get_frame_clock().connect("after-paint", self.on_first_frame)
+
+    def on_first_frame(self, clock):
+        clock.disconnect_by_func(self.on_first_frame)
+        trace.instant("first frame", "ui")
+        if not STARTUP_PROBE:
+            return
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"startup-probe first-frame rss_kb={rss} modules={len(sys.modules)}", flush=True)
+        self.quit()
+
+    def collect_data(self):
+        """Run GCollector off the main thread
+
+        Results cached from the last run are shown right away, then every
+        probe whose inputs changed is run again. Every finished probe is
+        handed to the main loop, which fills in its rows while the
+        remaining probes are still running.
+        """
+        collector = GCollector()
+        with trace.span("collect_data"):
+            collector.collect_data(
+                concurrent=True,
+                callback=lambda _probe, data: GLib.idle_add(self.win.update_data, data),
+                cache=SnapshotCache(SNAPSHOT_FILE),
+            )
+        # ~ Serialize here rather than on the main loop, the bytes are then
+        # ~ reused for every send attempt
+        with trace.span("serialize", "upload"):
+            payload = collector.payload()
+            payload.bytes
+        GLib.idle_add(self.on_data_collected, collector, payload)
+
+    def on_data_collected(self, collector, payload):
+        self.payload = payload
+        self.lookup_action("send").set_enabled(True)
+        self.start_spool_flusher()
+        # ~ The launcher leaves SIGINT at its default, which skips atexit
+        trace.flush()
+
+        # ~ Keep the rows, and what gets sent, current from now on
+        from .monitor import LiveMonitor
+        self.monitor = LiveMonitor(collector, self.on_data_changed)
+        self.monitor.start()
+
+        # ~ Sending again is only refused when nothing changed since
+        if already_uploaded(payload):
             self.win.bottom_bar.hide()
             self.win.view_stack.set_visible_child(self.win.already_submitted)
 
-        
-        self.data = GCollector().collect_data()
-        print(self.data)
-        
-        
-        self.win.default_browser = self.data['Default browser']
-        self.win.salted_machine_id_hash.set_subtitle(self.data['Unique ID'])
-        self.win.workspaces_on_primary_display.set_label(str(self.data["Workspaces only on primary"]))
-        self.win.dynamic_or_fixed_workspaces.set_label(str(self.data["Workspaces dynamic"]))
-        self.win.number_of_user_accounts.set_label(str(self.data["Number of users"]))
-        self.win.remote_desktop.set_label(str(self.data["Remote desktop"]))
-        self.win.remote_login.set_label(str(self.data["Remote login"]))
-        self.win.multimedia_sharing.set_label(str(self.data["Multimedia sharing"]))
-        self.win.file_sharing.set_label(str(self.data["File sharing"]))
-        self.win.flathub_enabled.set_label(str(self.data["Flathub enabled"]))
-        self.win.flatpak_installed.set_label(str(self.data["Flatpak installed"]))
-        self.win.operating_system.set_label(self.data["Operating system"])
-        self.win.hardware_model.set_label(self.data["Hardware model"])
-        self.win.hardware_vendor.set_label(self.data["Hardware vendor"])
-        
-        accounts = self.data["Online accounts"]
-        if accounts:
-            for account in accounts:
-                print(account)
-                account_row = Adw.ActionRow()
-                account_row.set_title(str(account))
-                self.win.online_accounts.add_row(account_row)
-                self.win.online_accounts.remove(self.win.no_online_accounts)
-                
-        favourite_apps = self.data["Favourited apps"]
-        if favourite_apps:
-            for favourite in favourite_apps:
-                row = Adw.ActionRow()
-                row.set_title(str(favourite))
-                self.win.favourited_apps.add_row(row)
-                self.win.favourited_apps.remove(self.win.no_favourited_apps)
-                
-        installed_apps = self.data["Installed apps"]
-        if installed_apps:
-            for installed in installed_apps:
-                row = Adw.ActionRow()
-                row.set_title(str(installed))
-                self.win.installed_apps.add_row(row)
-                self.win.installed_apps.remove(self.win.no_installed_apps)
-                
-        enabled_extensions = self.data["Enabled extensions"]
-        if installed_apps:
-            for extension in enabled_extensions:
-                row = Adw.ActionRow()
-                row.set_title(str(extension))
-                self.win.enabled_extensions.add_row(row)
-                self.win.enabled_extensions.remove(self.win.no_enabled_extensions)
-        
-        self.data = json.dumps(self.data)
+    def on_data_changed(self, data):
+        self.win.update_data(data)
+        self.payload = self.monitor.collector.payload()
+
+        # ~ Changed since the last upload, so it can be sent again
+        if (self.win.view_stack.get_visible_child() is self.win.already_submitted
+                and not already_uploaded(self.payload)):
+            self.win.bottom_bar.show()
+            self.win.view_stack.set_visible_child(self.win.main)
+
+    def start_spool_flusher(self):
+        """Send what failed to upload in earlier runs once online"""
+
+        if self.flusher is not None:
+            return
+        from .spool import Spool, SpoolFlusher
+        self.spool = Spool(SPOOL_DIR)
+        self.flusher = SpoolFlusher(self.spool, self.server, on_sent=self.on_spool_sent)
+        self.flusher.start()
+
+    def on_spool_sent(self, payload, spooled_at):
+        # ~ An upload made after this entry was spooled sent newer data,
+        # ~ it stays the base of the next delta
+        uploaded_at = last_upload_time()
+        if uploaded_at is None or spooled_at > uploaded_at:
+            create_status_file(payload)
 
     def show_about_window(self, *_args):
         """Callback for the app.about action."""
@@ -231,6 +315,8 @@ class AccumulateApplication(Adw.Application):
         
     def on_server_entry_changed(self, widget):
         self.server = widget.get_text()
+        if self.flusher is not None:
+            self.flusher.address = self.server
         self.settings.set_string("server-url", self.server)
 
     def create_action(self, name, callback, shortcuts=None):
@@ -251,5 +337,8 @@ class AccumulateApplication(Adw.Application):
 
 def main():
     """The application's entry point."""
+    if not is_gnome_desktop():
+        print("This tool must be run from a GNOME desktop.")
+        return 1
     app = AccumulateApplication()
     return app.run(sys.argv)
@@ -0,0 +1,167 @@
+# monitor.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from gi.repository import GLib, Gio
+
+from .client import GCollector, APPLICATIONS_DIRS, _settings, _typelib
+
+# ~ Milliseconds to wait for a burst of changes to settle before a probe
+# ~ runs again, e.g. a package manager writing many desktop files
+DEBOUNCE = 500
+
+SHARING_PATH = "/org/gnome/settings-daemon/plugins/sharing/"
+
+# ~ (schema, path, keys, probe) of the settings watched for changes
+WATCHED_SETTINGS = (
+    ("org.gnome.shell", None, ("favorite-apps",), "_get_favourited_apps"),
+    ("org.gnome.shell", None, ("enabled-extensions", "disabled-extensions",
+                               "disable-user-extensions"), "_get_enabled_extensions"),
+    ("org.gnome.mutter", None, ("workspaces-only-on-primary", "dynamic-workspaces"),
+     "_get_workspaces_status"),
+    *(
+        ("org.gnome.settings-daemon.plugins.sharing.service", SHARING_PATH + service + "/",
+         ("enabled-connections",), "_get_sharing_settings")
+        for service in ("gnome-user-share-webdav", "gnome-remote-desktop",
+                        "vino-server", "rygel")
+    ),
+    ("org.gnome.desktop.remote-desktop.rdp", "/org/gnome/desktop/remote-desktop/rdp/",
+     ("enable",), "_get_sharing_settings"),
+)
+
+# ~ Probes depending on the applications directories
+APPLICATIONS_PROBES = ("_get_installed_apps", "_get_default_browser")
+
+
+class LiveMonitor():
+    """Runs probes again when their inputs change
+
+    Watches the applications directories, the GSettings keys in
+    WATCHED_SETTINGS and GNOME Online Accounts. Changes are collected for
+    DEBOUNCE milliseconds, then only the affected probes run again, on a
+    worker thread. Must be started from the main loop.
+    """
+
+    def __init__(self, collector: GCollector, on_update):
+        """
+        @param on_update: called as on_update(data) on the main loop with
+                          the keys of every probe that ran again
+        """
+
+        self.collector = collector
+        self.on_update = on_update
+        self._pending = set()
+        self._timeout_id = 0
+        self._running = False
+        # ~ Monitors and settings only emit signals while referenced
+        self._sources = []
+
+    def start(self):
+        for appdir in APPLICATIONS_DIRS:
+            monitor = Gio.File.new_for_path(appdir).monitor_directory(
+                Gio.FileMonitorFlags.WATCH_MOVES, None
+            )
+            monitor.connect("changed", self._on_file_changed)
+            self._sources.append(monitor)
+
+        for schema, path, keys, probe in WATCHED_SETTINGS:
+            try:
+                settings = _settings(schema, path)
+            except KeyError:
+                continue  # Schema not installed, nothing to watch
+            for key in keys:
+                if not settings.props.settings_schema.has_key(key):
+                    continue
+                settings.connect(f"changed::{key}", self._on_setting_changed, probe)
+                # ~ GSettings only reports changes of keys read once
+                settings.get_value(key)
+            self._sources.append(settings)
+
+        self._watch_online_accounts()
+
+    def _watch_online_accounts(self):
+        Goa = _typelib('Goa', '1.0')
+        if Goa is not None:
+            Goa.Client.new(None, self._on_goa_client)
+            return
+
+        # ~ Same signals as Goa.Client, straight from the object manager
+        connection = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        for signal in ("InterfacesAdded", "InterfacesRemoved"):
+            connection.signal_subscribe(
+                "org.gnome.OnlineAccounts", "org.freedesktop.DBus.ObjectManager",
+                signal, "/org/gnome/OnlineAccounts", None,
+                Gio.DBusSignalFlags.NONE,
+                lambda *_args: self.queue("_get_online_accounts"),
+            )
+
+    def _on_goa_client(self, _source, result):
+        try:
+            client = _typelib('Goa', '1.0').Client.new_finish(result)
+        except GLib.Error:
+            return  # No goa-daemon, accounts cannot change either
+        for signal in ("account-added", "account-removed", "account-changed"):
+            client.connect(signal, lambda *_args: self.queue("_get_online_accounts"))
+        self._sources.append(client)
+
+    def _on_file_changed(self, _monitor, _file, _other, event):
+        if event in (Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                     Gio.FileMonitorEvent.CREATED,
+                     Gio.FileMonitorEvent.DELETED,
+                     Gio.FileMonitorEvent.MOVED_IN,
+                     Gio.FileMonitorEvent.MOVED_OUT,
+                     Gio.FileMonitorEvent.RENAMED):
+            for probe in APPLICATIONS_PROBES:
+                self.queue(probe)
+
+    def _on_setting_changed(self, _settings, _key, probe):
+        self.queue(probe)
+
+    def queue(self, probe: str):
+        """Run probe again once no change came in for DEBOUNCE ms"""
+
+        self._pending.add(probe)
+        if self._timeout_id:
+            GLib.source_remove(self._timeout_id)
+        self._timeout_id = GLib.timeout_add(DEBOUNCE, self._on_settled)
+
+    def _on_settled(self):
+        self._timeout_id = 0
+        # ~ A run in progress picks the pending probes up when it is done
+        if not self._running:
+            self._run_pending()
+        return GLib.SOURCE_REMOVE
+
+    def _run_pending(self):
+        probes, self._pending = list(self._pending), set()
+        self._running = True
+        threading.Thread(target=self._refresh, args=(probes,), daemon=True).start()
+
+    def _refresh(self, probes: list):
+        data = dict()
+        try:
+            data = self.collector.refresh(probes)
+        finally:
+            GLib.idle_add(self._refreshed, data)
+
+    def _refreshed(self, data: dict):
+        self._running = False
+        if data:
+            self.on_update(data)
+        if self._pending and not self._timeout_id:
+            self._run_pending()
@@ -0,0 +1,161 @@
+# payload.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import hashlib
+from collections import Counter
+
+from . import encoding
+
+
+class Payload():
+    """Collected data, serialized exactly once
+
+    The canonical form is compact, key-sorted UTF-8 JSON, so equal data
+    always gives equal bytes and an equal digest. The data must not be
+    modified after the payload is created.
+    """
+
+    def __init__(self, data: dict):
+        self.data = data
+        self._bytes = None
+        self._digest = None
+        self._encoded = dict()
+
+    @property
+    def bytes(self) -> bytes:
+        if self._bytes is None:
+            self._bytes = json.dumps(
+                self.data, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+            ).encode()
+        return self._bytes
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 of the canonical bytes, hex encoded"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.bytes).hexdigest()
+        return self._digest
+
+    @property
+    def content_digest(self) -> str:
+        """Digest that ignores the order of unordered lists, see DeltaPayload"""
+        return canonical_digest(self.data)
+
+    def encoded(self, content_encoding: str) -> bytes:
+        """Canonical bytes compressed with content_encoding, cached as well"""
+        if content_encoding not in self._encoded:
+            self._encoded[content_encoding] = encoding.encode(self.bytes, content_encoding)
+        return self._encoded[content_encoding]
+
+    def headers(self, content_encoding: str = encoding.IDENTITY) -> dict:
+        # ~ Identical re-sends carry the same key, so the server can drop them
+        headers = {
+            "Content-Type": "application/json",
+            "Idempotency-Key": self.digest,
+        }
+        headers.update(encoding.headers(content_encoding))
+        return headers
+
+
+# ~ List keys whose order carries no meaning, sent as added/removed items
+UNORDERED_KEYS = ("Installed apps", "Online accounts", "Enabled extensions")
+
+DELTA_CONTENT_TYPE = "application/vnd.accumulate.delta+json"
+# ~ Request header naming the digest of the payload a delta applies to
+DELTA_BASE_HEADER = "Accumulate-Delta-Base"
+
+
+class DeltaPayload(Payload):
+    """Changes between the last uploaded payload and a new one
+
+    The delta carries the Unique ID and the content digests of the base
+    and of the new payload, so the server can check it still holds the
+    base and that applying the delta gives exactly the new payload.
+    """
+
+    def __init__(self, base: Payload, new: Payload):
+        added, removed, changed = dict(), dict(), dict()
+        for key, value in new.data.items():
+            old = base.data.get(key)
+            if old == value:
+                continue
+            if key in UNORDERED_KEYS and isinstance(old, list) and isinstance(value, list):
+                plus, minus = _multiset_diff(old, value)
+                if plus:
+                    added[key] = plus
+                if minus:
+                    removed[key] = minus
+            else:
+                changed[key] = value
+
+        super().__init__({
+            "Unique ID": new.data.get("Unique ID"),
+            "Base": base.content_digest,
+            "Digest": new.content_digest,
+            "Added": added,
+            "Removed": removed,
+            "Changed": changed,
+            # ~ Keys present in the base but not collected anymore
+            "Deleted": sorted(set(base.data) - set(new.data)),
+        })
+        self.base = base
+        self.new = new
+
+    def headers(self, content_encoding: str = encoding.IDENTITY) -> dict:
+        headers = super().headers(content_encoding)
+        headers["Content-Type"] = DELTA_CONTENT_TYPE
+        headers[DELTA_BASE_HEADER] = self.base.content_digest
+        return headers
+
+
+def _multiset_diff(old: list, new: list):
+    """Items to add to and remove from old to get new, duplicates included"""
+
+    plus = Counter(new)
+    plus.subtract(Counter(old))
+    added = sorted(v for v, n in plus.items() for _ in range(n) if n > 0)
+    removed = sorted(v for v, n in plus.items() for _ in range(-n) if n < 0)
+    return added, removed
+
+
+def apply_delta(base: dict, delta: dict) -> dict:
+    """Rebuild the new payload data from the base data and a delta
+
+    Unordered lists come out sorted, check the result against the
+    delta's "Digest" with canonical_digest().
+    """
+
+    data = {k: v for k, v in base.items() if k not in delta.get("Deleted", ())}
+    for key, items in delta.get("Removed", {}).items():
+        counts = Counter(data.get(key, []))
+        counts.subtract(Counter(items))
+        data[key] = sorted(counts.elements())
+    for key, items in delta.get("Added", {}).items():
+        data[key] = sorted(data.get(key, []) + items)
+    data.update(delta.get("Changed", {}))
+    return data
+
+
+def canonical_digest(data: dict) -> str:
+    """Digest of data with unordered lists sorted, for comparing contents"""
+
+    data = {
+        k: sorted(v) if k in UNORDERED_KEYS and isinstance(v, list) else v
+        for k, v in data.items()
+    }
+    return Payload(data).digest
@@ -0,0 +1,139 @@
+# probes.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# ~ Cost classes, cheapest first: the most expensive thing a probe does
+# ~ when it does not need to fall back
+FILE = 0
+GSETTINGS = 1
+DBUS = 2
+SUBPROCESS = 3
+
+COSTS = {"file": FILE, "gsettings": GSETTINGS, "dbus": DBUS, "subprocess": SUBPROCESS}
+
+
+class Probe():
+    """What the registry knows about one probe"""
+
+    def __init__(self, name: str, func, keys: tuple, cost: int, resource: str = None):
+        self.name = name
+        self.func = func
+        self.keys = keys
+        self.cost = cost
+        # ~ Probes with the same resource run one after another on one
+        # ~ worker, so the connection or cache behind it is set up once
+        self.resource = resource
+
+    def __repr__(self):
+        return f"<Probe {self.name} cost={self.cost} resource={self.resource}>"
+
+
+class ProbeRegistry():
+    """Probes of a collector, in the order their keys appear in the data
+
+    Probes are registered with the probe() decorator, or by calling it
+    on a function taking the collector:
+
+        class Collector(GCollector):
+            registry = GCollector.registry.copy()
+
+            @registry.probe("Kernel", cost=FILE)
+            def _get_kernel(self):
+                ...
+    """
+
+    def __init__(self):
+        self._probes = dict()
+
+    def probe(self, *keys: str, cost: int = FILE, resource: str = None):
+        """Decorator registering a method as the probe producing keys"""
+
+        def register(func):
+            self._probes[func.__name__] = Probe(func.__name__, func, keys, cost, resource)
+            return func
+        return register
+
+    def copy(self) -> "ProbeRegistry":
+        registry = ProbeRegistry()
+        registry._probes = dict(self._probes)
+        return registry
+
+    def __getitem__(self, name: str) -> Probe:
+        return self._probes[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._probes
+
+    def __iter__(self):
+        return iter(self._probes.values())
+
+    @property
+    def names(self) -> list:
+        return list(self._probes)
+
+    @property
+    def keys(self) -> list:
+        """Every key the probes produce, in data order"""
+        return [key for probe in self for key in probe.keys]
+
+    def for_keys(self, keys: list) -> list:
+        """Names of the probes producing keys, in data order
+
+        @raise KeyError: for a key no probe produces
+        """
+
+        names = set()
+        for key in keys:
+            for probe in self:
+                if key in probe.keys:
+                    names.add(probe.name)
+                    break
+            else:
+                raise KeyError(key)
+        return [name for name in self._probes if name in names]
+
+    def select(self, names: list = None, keys: list = None,
+               max_cost: int = None) -> list:
+        """Names of the probes to run, in data order
+
+        @param names: only these probes, defaults to all
+        @param keys: only the probes producing these keys
+        @param max_cost: skip probes of a higher cost class
+        """
+
+        selected = self.names if names is None else [n for n in self._probes if n in names]
+        if keys is not None:
+            wanted = self.for_keys(keys)
+            selected = [name for name in selected if name in wanted]
+        if max_cost is not None:
+            selected = [name for name in selected if self[name].cost <= max_cost]
+        return selected
+
+    def schedule(self, names: list) -> list:
+        """Split names into batches to run, cheapest first
+
+        Probes sharing a resource form one batch, run one after another.
+        Batches are ordered by their cheapest probe and probes within a
+        batch by cost, so cheap results are available first.
+        """
+
+        ordered = sorted(names, key=lambda name: (self[name].cost, self.names.index(name)))
+        batches = dict()
+        for name in ordered:
+            resource = self[name].resource
+            group = ("probe", name) if resource is None else ("resource", resource)
+            batches.setdefault(group, []).append(name)
+        return list(batches.values())
@@ -0,0 +1,85 @@
+# snapshot.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+
+# ~ Bump whenever a probe changes what it stores, to drop older snapshots
+SNAPSHOT_VERSION = 1
+
+
+def file_stamp(path: str):
+    """Modification time of path in nanoseconds, None if it is missing"""
+
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class SnapshotCache():
+    """Results of the last collection, stored per probe
+
+    Every entry keeps the invalidation key computed from the probe's
+    inputs before it ran. A cached result is only used while the key
+    computed now is the same.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._probes = self._load()
+        self._changed = False
+
+    def lookup(self, probe: str, key):
+        """Cached data of probe, None if missing or stale"""
+
+        if key is None:
+            return None
+        entry = self._probes.get(probe)
+        if entry is None or entry["key"] != key:
+            return None
+        return entry["data"]
+
+    def store(self, probe: str, key, data: dict):
+        if key is None:
+            return
+        # ~ Round-trip through JSON so keys compare equal after a reload
+        self._probes[probe] = json.loads(json.dumps({"key": key, "data": data}))
+        self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"version": SNAPSHOT_VERSION, "probes": self._probes}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass  # Next launch just collects everything again
+        self._changed = False
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+            if snapshot.get("version") == SNAPSHOT_VERSION:
+                return snapshot["probes"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return dict()
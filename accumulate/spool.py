@@ -0,0 +1,208 @@
+# spool.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import threading
+
+import requests
+from gi.repository import GLib, Gio
+
+from .payload import Payload
+from .upload import Uploader
+
+# ~ Bounds of the spool, the oldest entries are evicted first
+SPOOL_MAX_ENTRIES = 32
+SPOOL_MAX_BYTES = 4 * 1024 * 1024
+
+# ~ Entries sent per flush, over one kept-alive connection
+SPOOL_BATCH = 8
+
+# ~ Subdirectory entries the server refused for good are moved to
+REJECTED_DIR = "rejected"
+# ~ 4xx replies that may go away by themselves: timeout, rate limited
+RETRYABLE = (408, 429)
+
+
+class Spool():
+    """Payloads that could not be uploaded, kept on disk until they are
+
+    Every entry is one file, written to a temporary name and renamed into
+    place, so a crash never leaves a partial entry behind. File names
+    start with the spooling time, so sorting them gives the oldest first.
+    """
+
+    def __init__(self, directory: str, max_entries: int = SPOOL_MAX_ENTRIES,
+                 max_bytes: int = SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def put(self, payload: Payload):
+        name = f"{time.time_ns():020d}-{payload.digest[:16]}.json"
+        path = os.path.join(self.directory, name)
+        tmp = os.path.join(self.directory, "." + name + ".tmp")
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(payload.bytes)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            self._evict()
+
+    def entries(self, directory: str = None) -> list:
+        """Names of the spooled entries, oldest first"""
+
+        try:
+            names = os.listdir(directory or self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n.endswith(".json") and not n.startswith("."))
+
+    def load(self, name: str) -> Payload:
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return Payload(json.loads(f.read()))
+
+    @staticmethod
+    def spooled_at(name: str) -> int:
+        """Time an entry was spooled at, in nanoseconds since the epoch"""
+        return int(name.split("-", 1)[0])
+
+    def remove(self, name: str, directory: str = None):
+        try:
+            os.remove(os.path.join(directory or self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def reject(self, name: str):
+        """Move an entry the server refused out of the spool
+
+        Kept in REJECTED_DIR for inspection, up to max_entries of them.
+        """
+
+        rejected = os.path.join(self.directory, REJECTED_DIR)
+        with self._lock:
+            os.makedirs(rejected, exist_ok=True)
+            try:
+                os.replace(os.path.join(self.directory, name), os.path.join(rejected, name))
+            except FileNotFoundError:
+                return
+            entries = self.entries(rejected)
+            for old in entries[:max(0, len(entries) - self.max_entries)]:
+                self.remove(old, rejected)
+
+    def flush(self, uploader: Uploader, batch: int = SPOOL_BATCH, on_sent=None) -> int:
+        """Upload up to batch entries, oldest first
+
+        An entry is removed once the server accepted it, and moved to
+        REJECTED_DIR once the server refused it with a 4xx, other than
+        one in RETRYABLE. Flushing stops at the first connection error,
+        timeout, 5xx or RETRYABLE reply, those entries are kept.
+
+        @param on_sent: called as on_sent(payload, spooled_at) for every
+                        accepted entry, see spooled_at()
+        @return: number of entries sent
+        """
+
+        sent = 0
+        for name in self.entries():
+            if sent == batch:
+                break
+            try:
+                payload = self.load(name)
+            except (OSError, ValueError):
+                self.remove(name)  # Unreadable, it can never be sent
+                continue
+            try:
+                uploader.post(payload)
+            except requests.HTTPError as e:
+                status = e.response.status_code
+                if status >= 500 or status in RETRYABLE:
+                    break
+                self.reject(name)  # Sending it again would fail the same way
+                continue
+            except (requests.ConnectionError, requests.Timeout):
+                break
+            self.remove(name)
+            sent += 1
+            if on_sent:
+                on_sent(payload, self.spooled_at(name))
+        return sent
+
+    def _evict(self):
+        entries = self.entries()
+        sizes = dict()
+        for name in entries:
+            try:
+                sizes[name] = os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                sizes[name] = 0
+        total = sum(sizes.values())
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            name = entries.pop(0)
+            total -= sizes[name]
+            self.remove(name)
+
+
+class SpoolFlusher():
+    """Drains a Spool in the background whenever the network is available
+
+    Watches Gio.NetworkMonitor and flushes once at start. Only one flush
+    runs at a time, on a worker thread.
+    """
+
+    def __init__(self, spool: Spool, address: str, on_sent=None):
+        """
+        @param on_sent: called as on_sent(payload, spooled_at) on the main
+                        loop for every entry the server accepted
+        """
+
+        self.spool = spool
+        self.address = address
+        self.on_sent = on_sent
+        self._running = False
+        self._monitor = Gio.NetworkMonitor.get_default()
+        self._monitor.connect("network-changed", self._on_network_changed)
+
+    def start(self):
+        self._on_network_changed(self._monitor, self._monitor.get_network_available())
+
+    def _on_network_changed(self, _monitor, available):
+        if not available or self._running or not self.spool.entries():
+            return
+        self._running = True
+        threading.Thread(target=self._flush, daemon=True).start()
+
+    def _flush(self):
+        uploader = Uploader(self.address)
+        try:
+            while self.spool.flush(uploader, on_sent=self._sent) == SPOOL_BATCH:
+                pass
+        finally:
+            uploader.close()
+            GLib.idle_add(self._flushed)
+
+    def _sent(self, payload: Payload, spooled_at: int):
+        if self.on_sent:
+            GLib.idle_add(self.on_sent, payload, spooled_at)
+
+    def _flushed(self):
+        self._running = False
@@ -0,0 +1,427 @@
+# store.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Append-only store of received submissions
+
+Records are appended to numbered segment files, each record a fixed
+header followed by the JSON of the submission:
+
+    body length  u32
+    CRC-32       u32   of the Unique ID and the body
+    Unique ID    32 bytes, the SHA-256 digest, zeros if unknown
+    body         canonical JSON
+
+Next to every segment, an index file holds the offset of every
+INDEX_INTERVAL-th record, so opening the store only checks the records
+after the last indexed one, and seeking to a record skips headers only.
+"""
+
+import os
+import json
+import mmap
+import zlib
+import bisect
+import struct
+import threading
+
+HEADER = struct.Struct("<II32s")
+INDEX_ENTRY = struct.Struct("<QQ")  # Record number in the segment, offset
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+INDEX_INTERVAL = 64
+NO_ID = bytes(32)
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+
+def _encode(record: dict) -> tuple:
+    """(Unique ID bytes, body) of a submission"""
+
+    try:
+        uid = bytes.fromhex(record.get("Unique ID", ""))
+    except (TypeError, ValueError):
+        uid = NO_ID
+    if len(uid) != 32:
+        uid = NO_ID
+    body = json.dumps(record, ensure_ascii=False, sort_keys=True,
+                      separators=(",", ":")).encode()
+    return uid, body
+
+
+def _checksum(uid: bytes, body) -> int:
+    return zlib.crc32(body, zlib.crc32(uid))
+
+
+def _map(path: str, size: int):
+    """Read-only mmap of the first size bytes of path, None if empty
+
+    Maps less when the file is shorter by now, compact() may have
+    replaced it since size was taken. The mapping holds on to the file
+    it was made from, whatever is renamed over it later.
+    """
+
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        size = min(size, os.fstat(f.fileno()).st_size)
+        if size == 0:
+            return None
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    if hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+class Segment():
+    """One segment file and its sparse index"""
+
+    def __init__(self, directory: str, seq: int):
+        self.seq = seq
+        self.path = os.path.join(directory, f"{seq:010d}{SEGMENT_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{seq:010d}{INDEX_SUFFIX}")
+        self.count = 0
+        self.size = 0
+        # ~ (record number, offset) of every INDEX_INTERVAL-th record
+        self.index = []
+
+    def recover(self, readonly: bool = False):
+        """Load the index and check the records after its last entry
+
+        A torn record at the end, left by a crash during a write, is cut
+        off. An index that does not match the segment is rebuilt.
+
+        @param readonly: leave the files alone, an incomplete record at
+                         the end, possibly still being written, is where
+                         the segment ends for now
+        """
+
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        entries = self._load_index()
+        mm = _map(self.path, size)
+        size = len(mm) if mm is not None else 0
+        try:
+            if entries and self._is_record(mm, size, entries[-1][1]):
+                # ~ The last entry is added back by the loop
+                self.index = entries[:-1]
+                number, offset = entries[-1]
+            else:
+                self.index = []
+                number, offset = 0, 0
+            while offset < size and self._is_record(mm, size, offset):
+                if number % INDEX_INTERVAL == 0:
+                    self.index.append((number, offset))
+                length, _crc, _uid = HEADER.unpack_from(mm, offset)
+                offset += HEADER.size + length
+                number += 1
+        finally:
+            if mm is not None:
+                mm.close()
+
+        self.count = number
+        self.size = offset
+        if readonly:
+            return
+        if offset < size:
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        if self.index != entries:
+            self._save_index()
+
+    def _is_record(self, mm, size: int, offset: int) -> bool:
+        if mm is None or offset + HEADER.size > size:
+            return False
+        length, crc, uid = HEADER.unpack_from(mm, offset)
+        end = offset + HEADER.size + length
+        return end <= size and _checksum(uid, mm[offset + HEADER.size:end]) == crc
+
+    def _load_index(self) -> list:
+        try:
+            with open(self.index_path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return []
+        # ~ A partly written last entry is ignored
+        content = content[:len(content) - len(content) % INDEX_ENTRY.size]
+        return [entry for entry in INDEX_ENTRY.iter_unpack(content)]
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+        os.replace(tmp, self.index_path)
+
+    def seek(self, mm, number: int) -> int:
+        """Offset of record number, from the nearest indexed record"""
+
+        if number >= self.count:
+            return self.size
+        i = bisect.bisect_right(self.index, (number, float("inf"))) - 1
+        current, offset = self.index[i]
+        while current < number and offset + HEADER.size <= len(mm):
+            length, _crc, _uid = HEADER.unpack_from(mm, offset)
+            offset += HEADER.size + length
+            current += 1
+        return offset
+
+
+class SubmissionStore():
+    """Segmented append-only store of submissions
+
+    append() writes a batch with a single fsync. Segments roll over at
+    segment_size bytes. scan() reads through mmap, handing out views of
+    the records without copying them. compact() rewrites the full
+    segments, keeping only the latest record of every Unique ID; the
+    segment being appended to is left alone. Safe to use from several
+    threads.
+
+    Only one process may open a store for writing. Readers open it with
+    readonly, they never change the files and see the records that were
+    complete when the store was opened.
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE,
+                 sync: bool = True, readonly: bool = False):
+        """
+        @param sync: fsync every appended batch
+        @param readonly: open for scan(), records(), read() and latest()
+                         only, e.g. next to a running ingest server
+        """
+
+        if readonly:
+            if not os.path.isdir(directory):
+                raise FileNotFoundError(f"No store at {directory}")
+        else:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._compacting = threading.Lock()
+        self._stop = threading.Event()
+
+        seqs = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        self.segments = [Segment(directory, seq) for seq in seqs] or [Segment(directory, 0)]
+        for segment in self.segments:
+            segment.recover(readonly)
+        if not readonly:
+            self._open_active()
+
+    def _open_active(self):
+        active = self.segments[-1]
+        self._file = open(active.path, "ab")
+        self._index_file = open(active.index_path, "ab")
+
+    def __len__(self):
+        with self._lock:
+            return sum(segment.count for segment in self.segments)
+
+    def append(self, records: list) -> list:
+        """Append submissions, durably unless sync is off
+
+        @return: (segment, offset) of every record, valid until the
+                 segment is compacted
+        """
+
+        if self.readonly:
+            raise PermissionError(f"{self.directory} is open read-only")
+        positions = []
+        with self._lock:
+            for record in records:
+                uid, body = _encode(record)
+                active = self.segments[-1]
+                if active.count and active.size + HEADER.size + len(body) > self.segment_size:
+                    self._roll()
+                    active = self.segments[-1]
+
+                if active.count % INDEX_INTERVAL == 0:
+                    active.index.append((active.count, active.size))
+                    self._index_file.write(INDEX_ENTRY.pack(active.count, active.size))
+                self._file.write(HEADER.pack(len(body), _checksum(uid, body), uid))
+                self._file.write(body)
+                positions.append((active.seq, active.size))
+                active.size += HEADER.size + len(body)
+                active.count += 1
+
+            self._file.flush()
+            self._index_file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+        return positions
+
+    def _roll(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._index_file.close()
+        self.segments.append(Segment(self.directory, self.segments[-1].seq + 1))
+        self._open_active()
+
+    def _snapshot(self) -> list:
+        """(segment, its size and count) of every segment, for readers"""
+
+        with self._lock:
+            return [(segment, segment.size, segment.count) for segment in self.segments]
+
+    def scan(self, start: tuple = None):
+        """Yield (position, Unique ID bytes, body) of every record, oldest first
+
+        @param start: (segment, record number) to start from
+
+        Bodies are memoryviews into the mapped segment, only valid while
+        the iteration is on that segment: copy what needs to outlive it.
+        """
+
+        start_seq, start_number = start or (0, 0)
+        for segment, size, count in self._snapshot():
+            if segment.seq < start_seq:
+                continue
+            # ~ Not closed explicitly, the mapping goes away once the
+            # ~ caller dropped the views it was handed
+            mm = _map(segment.path, size)
+            if mm is None:
+                continue
+            size = len(mm)
+            view = memoryview(mm)
+            offset = 0
+            if segment.seq == start_seq and start_number:
+                offset = min(segment.seek(mm, start_number), size)
+            while offset + HEADER.size <= size:
+                length, _crc, uid = HEADER.unpack_from(mm, offset)
+                body_start = offset + HEADER.size
+                if body_start + length > size:
+                    break  # Cut short by a compaction since the snapshot
+                yield (segment.seq, offset), uid, view[body_start:body_start + length]
+                offset = body_start + length
+
+    def records(self, start: tuple = None):
+        """Yield every submission as a dict, oldest first"""
+
+        for _position, _uid, body in self.scan(start):
+            yield json.loads(bytes(body))
+
+    def read(self, position: tuple) -> dict:
+        """Submission at a position append() returned"""
+
+        seq, offset = position
+        path = os.path.join(self.directory, f"{seq:010d}{SEGMENT_SUFFIX}")
+        with open(path, "rb") as f:
+            length, crc, uid = HEADER.unpack(os.pread(f.fileno(), HEADER.size, offset))
+            body = os.pread(f.fileno(), length, offset + HEADER.size)
+        if _checksum(uid, body) != crc:
+            raise ValueError(f"No record at {position}")
+        return json.loads(body)
+
+    def latest(self) -> dict:
+        """Unique ID bytes -> position of its latest record
+
+        Only reads the record headers.
+        """
+
+        latest = dict()
+        for segment, size, _count in self._snapshot():
+            mm = _map(segment.path, size)
+            if mm is None:
+                continue
+            size = len(mm)
+            try:
+                offset = 0
+                while offset + HEADER.size <= size:
+                    length, _crc, uid = HEADER.unpack_from(mm, offset)
+                    if offset + HEADER.size + length > size:
+                        break
+                    latest[uid] = (segment.seq, offset)
+                    offset += HEADER.size + length
+            finally:
+                mm.close()
+        return latest
+
+    def compact(self) -> int:
+        """Drop records superseded by a later one of the same Unique ID
+
+        @return: number of records dropped
+        """
+
+        if self.readonly:
+            raise PermissionError(f"{self.directory} is open read-only")
+        with self._compacting:
+            latest = self.latest()
+            with self._lock:
+                sealed = self.segments[:-1]
+            return sum(self._compact_segment(segment, latest) for segment in sealed)
+
+    def _compact_segment(self, segment: Segment, latest: dict) -> int:
+        size = segment.size
+        mm = _map(segment.path, size)
+        if mm is None:
+            return 0
+
+        kept = Segment(self.directory, segment.seq)
+        dropped = 0
+        tmp = segment.path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                offset = 0
+                while offset < size:
+                    length, _crc, uid = HEADER.unpack_from(mm, offset)
+                    end = offset + HEADER.size + length
+                    if uid == NO_ID or latest.get(uid) == (segment.seq, offset):
+                        if kept.count % INDEX_INTERVAL == 0:
+                            kept.index.append((kept.count, kept.size))
+                        f.write(mm[offset:end])
+                        kept.size += end - offset
+                        kept.count += 1
+                    else:
+                        dropped += 1
+                    offset = end
+                if dropped:
+                    f.flush()
+                    os.fsync(f.fileno())
+        finally:
+            mm.close()
+
+        if not dropped:
+            os.remove(tmp)
+            return 0
+        # ~ A crash between the two leaves an index that does not match,
+        # ~ Segment.recover() then rebuilds it
+        kept._save_index()
+        os.replace(tmp, segment.path)
+        with self._lock:
+            segment.size, segment.count, segment.index = kept.size, kept.count, kept.index
+        return dropped
+
+    def start_compactor(self, interval: float = 3600):
+        """Run compact() every interval seconds on a daemon thread"""
+
+        def run():
+            while not self._stop.wait(interval):
+                self.compact()
+
+        threading.Thread(target=run, daemon=True, name="compactor").start()
+
+    def close(self):
+        self._stop.set()
+        if self.readonly:
+            return
+        with self._lock:
+            self._file.close()
+            self._index_file.close()
@@ -0,0 +1,178 @@
+# trace.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timed spans of collection, window population and upload
+
+Off unless the ACCUMULATE_TRACE environment variable is set, or
+enable() is called, e.g. by accumulate-collect --trace FILE. The spans
+are written as Chrome trace event JSON, which chrome://tracing and
+ui.perfetto.dev open, on flush() and at exit, when a one-line summary
+also goes to stderr. Only the last MAX_EVENTS events are kept.
+
+While off, span() returns a shared no-op context manager.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import collections
+
+TRACE_ENV = "ACCUMULATE_TRACE"
+MAX_EVENTS = 100000
+
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span():
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_exc):
+        self.tracer.add(self.name, self.category, self.start,
+                        time.perf_counter_ns() - self.start, self.args)
+        return False
+
+
+class Tracer():
+    """Collects complete ("X") trace events from any thread"""
+
+    def __init__(self, path: str, max_events: int = MAX_EVENTS):
+        self.path = path
+        self.start = time.perf_counter_ns()
+        # ~ Ring buffer, long runs such as --repeat 0 keep the latest events
+        self.events = collections.deque(maxlen=max_events)
+        self.threads = dict()
+
+    def span(self, name: str, category: str, args: dict) -> _Span:
+        return _Span(self, name, category, args)
+
+    def add(self, name: str, category: str, start: int, duration: int, args: dict = None):
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+        event = {
+            "name": name, "cat": category, "ph": "X", "pid": os.getpid(),
+            "tid": thread.ident, "ts": (start - self.start) / 1000, "dur": duration / 1000,
+        }
+        if args:
+            event["args"] = args
+        # ~ deque.append is atomic, no lock needed between probe threads
+        self.events.append(event)
+
+    def instant(self, name: str, category: str):
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+        self.events.append({
+            "name": name, "cat": category, "ph": "i", "s": "p", "pid": os.getpid(),
+            "tid": thread.ident, "ts": (time.perf_counter_ns() - self.start) / 1000,
+        })
+
+    def write(self):
+        """Replace the trace file with the buffered events"""
+
+        names = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+             "args": {"name": name}}
+            for tid, name in list(self.threads.items())
+        ]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"traceEvents": names + list(self.events), "displayTimeUnit": "ms"}, f)
+        os.replace(tmp, self.path)
+
+    def summary(self, slowest: int = 3) -> str:
+        spans = [e for e in list(self.events) if e["ph"] == "X"]
+        total = (time.perf_counter_ns() - self.start) / 1e6
+        top = sorted(spans, key=lambda e: e["dur"], reverse=True)[:slowest]
+        return (f"trace: {len(spans)} spans over {total:.1f} ms, slowest "
+                + ", ".join(f"{e['name']} {e['dur'] / 1000:.1f} ms" for e in top)
+                + f"; written to {self.path}")
+
+
+_tracer = None
+
+
+def enable(path: str = None) -> Tracer:
+    """Start tracing, the trace is written to path at exit"""
+
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(path or f"accumulate-trace-{os.getpid()}.json")
+        atexit.register(_finish)
+    return _tracer
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, category: str = "accumulate", **args):
+    """Context manager timing its block as one span"""
+
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, category, args)
+
+
+def instant(name: str, category: str = "accumulate"):
+    """Mark a moment, such as the first frame"""
+
+    if _tracer is not None:
+        _tracer.instant(name, category)
+
+
+def flush() -> bool:
+    """Write the trace file now, e.g. after every collection of a long run
+
+    @return: False if writing failed
+    """
+
+    if _tracer is None:
+        return True
+    try:
+        _tracer.write()
+    except OSError as e:
+        print(f"trace: writing {_tracer.path} failed: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+def _finish():
+    if flush():
+        print(_tracer.summary(), file=sys.stderr)
+
+
+if os.environ.get(TRACE_ENV):
+    enable(None if os.environ[TRACE_ENV] == "1" else os.environ[TRACE_ENV])
@@ -0,0 +1,224 @@
+# upload.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import encoding, trace
+from .payload import Payload, DeltaPayload, DELTA_CONTENT_TYPE
+
+# ~ Timeouts in seconds for opening the connection and for the reply
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# ~ Reply headers listing the request content encodings (RFC 7694) and
+# ~ the POST media types a server accepts
+ACCEPT_ENCODING = "Accept-Encoding"
+ACCEPT_POST = "Accept-Post"
+
+# ~ Replies to a compressed body meaning the server cannot decode it
+ENCODING_REJECTED = (400, 415)
+
+# ~ Attempts after the first one, and the backoff between them in seconds
+RETRIES = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 8
+
+
+class UploadCancelled(Exception):
+    """Raised by Uploader.post() when cancel() was called"""
+
+
+class Uploader():
+    """Posts collected data, retrying transient failures
+
+    Connection errors, timeouts and 5xx replies are retried with jittered
+    exponential backoff. Other HTTP errors are raised right away. All
+    attempts go through one requests.Session, so the connection is kept
+    alive between them.
+
+    Compression and deltas are only used with servers that advertise
+    them, see negotiate(); others get plain, full JSON. The body is
+    compressed with the most preferred encoding the server accepts and
+    has not refused yet. A 400 or 415 reply drops that encoding and the
+    payload is sent again right away, down to plain JSON.
+    """
+
+    def __init__(self, address: str, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, retries: int = RETRIES,
+                 compress: bool = True):
+        self.address = address
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.compress = compress
+        # ~ What the server accepts, filled in by negotiate()
+        self.encodings = [encoding.IDENTITY]
+        self.delta = False
+        self._negotiated = False
+        self._cancelled = threading.Event()
+        self._session = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+        return self._session
+
+    def negotiate(self):
+        """Ask the server which encodings and deltas it accepts, once
+
+        Sends OPTIONS and reads the ACCEPT_ENCODING and ACCEPT_POST
+        headers of the reply. Until a server answered, nothing is
+        compressed and no deltas are sent.
+        """
+
+        if self._negotiated:
+            return
+        try:
+            with trace.span("OPTIONS", "upload"):
+                r = self.session.options(self.address, timeout=self.timeout)
+        except requests.RequestException:
+            return  # Asked again on the next post()
+        self._negotiated = True
+        if not r.ok:
+            return
+
+        if self.compress:
+            accepted = _tokens(r.headers.get(ACCEPT_ENCODING, ""))
+            self.encodings = [e for e in encoding.available()
+                              if e in accepted or e == encoding.IDENTITY]
+        self.delta = DELTA_CONTENT_TYPE in _tokens(r.headers.get(ACCEPT_POST, ""))
+
+    def post(self, payload: Payload, base: Payload = None,
+             on_progress=None) -> requests.Response:
+        """Send payload, retrying transient failures
+
+        @param base: payload last uploaded successfully, if given and the
+                     server accepts deltas only the changes since are
+                     sent; any 4xx reply to them sends the full payload
+        @param on_progress: called as on_progress(attempt, attempts, delay)
+                            before every attempt, delay is the time waited
+                            before it in seconds
+        @return: the successful response
+        @raise: the error of the last attempt, or UploadCancelled
+        """
+
+        self._cancelled.clear()
+        self.negotiate()
+
+        if (self.delta and base is not None
+                and base.data.get("Unique ID") == payload.data.get("Unique ID")):
+            try:
+                return self._post_retrying(DeltaPayload(base, payload), on_progress)
+            except requests.HTTPError as e:
+                # ~ Unknown or stale base, or the delta is not understood
+                if e.response.status_code >= 500:
+                    raise
+        return self._post_retrying(payload, on_progress)
+
+    def _post_retrying(self, payload: Payload, on_progress) -> requests.Response:
+        attempts = self.retries + 1
+        delay = 0
+
+        for attempt in range(1, attempts + 1):
+            if on_progress:
+                on_progress(attempt, attempts, delay)
+            # ~ Sleep on the event, so cancel() also ends the wait
+            if self._cancelled.wait(delay):
+                raise UploadCancelled()
+
+            try:
+                r = self._post_negotiated(payload)
+                # ~ Raise HTTPError if request returned an unsuccessful status code
+                r.raise_for_status()
+                return r
+            except requests.HTTPError as e:
+                if e.response.status_code < 500 or attempt == attempts:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == attempts:
+                    raise
+
+            if self._cancelled.is_set():
+                raise UploadCancelled()
+            delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+
+    def _post_negotiated(self, payload: Payload) -> requests.Response:
+        while True:
+            content_encoding = self.encodings[0]
+            with trace.span("encode", "upload", encoding=content_encoding):
+                data = payload.encoded(content_encoding)
+            with trace.span("POST", "upload", bytes=len(data)):
+                r = self.session.post(
+                    self.address,
+                    data=data,
+                    headers=payload.headers(content_encoding),
+                    timeout=self.timeout,
+                )
+            if r.status_code not in ENCODING_REJECTED or content_encoding == encoding.IDENTITY:
+                return r
+            # ~ Not decodable after all, remember and try the next encoding
+            self.encodings.remove(content_encoding)
+
+    def post_async(self, payload: Payload, on_done, base: Payload = None,
+                   on_progress=None):
+        """Run post() on a worker thread
+
+        @param on_done: called as on_done(response, error) from the worker
+                        thread, exactly one of the two is None
+        """
+
+        def run():
+            try:
+                r = self.post(payload, base, on_progress)
+            except Exception as e:
+                on_done(None, e)
+            else:
+                on_done(r, None)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def cancel(self):
+        """Stop retrying; a request already on the wire runs to its timeout"""
+        self._cancelled.set()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def _tokens(header: str) -> set:
+    """Lower-cased values of a comma separated header, except those with q=0"""
+
+    tokens = set()
+    for item in header.split(","):
+        value, *params = (part.strip() for part in item.split(";"))
+        q = next((p[2:] for p in params if p.replace(" ", "").startswith("q=")), "1")
+        try:
+            refused = float(q.replace(" ", "").lstrip("=")) == 0
+        except ValueError:
+            refused = False
+        if value and not refused:
+            tokens.add(value.lower())
+    return tokens
@@ -15,10 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from ast import Gt
-from gi.repository import Gtk, Adw, Gio
+from gi.repository import Gtk, Adw, Gio, Pango
 
 from .constants import rootdir, app_id
+from . import trace
 
 
 @Gtk.Template(resource_path=f'{rootdir}/ui/window.ui')
@@ -38,6 +38,8 @@ class AccumulateWindow(Adw.ApplicationWindow):
     error_label = Gtk.Template.Child()
     content = Gtk.Template.Child()
     already_submitted = Gtk.Template.Child()
+    sending = Gtk.Template.Child()
+    sending_status = Gtk.Template.Child()
         
     hardware_model = Gtk.Template.Child()
     hardware_vendor = Gtk.Template.Child()
@@ -61,12 +63,121 @@ class AccumulateWindow(Adw.ApplicationWindow):
     no_installed_apps = Gtk.Template.Child()
     enabled_extensions = Gtk.Template.Child()
     no_enabled_extensions = Gtk.Template.Child()
+    online_accounts_row = Gtk.Template.Child()
+    online_accounts_list = Gtk.Template.Child()
+    favourited_apps_row = Gtk.Template.Child()
+    favourited_apps_list = Gtk.Template.Child()
+    installed_apps_row = Gtk.Template.Child()
+    installed_apps_list = Gtk.Template.Child()
+    enabled_extensions_row = Gtk.Template.Child()
+    enabled_extensions_list = Gtk.Template.Child()
     
     settings = Gio.Settings(app_id)
 
+    # ~ Collected data key -> suffix label showing it
+    LABELS = {
+        "Hardware model": "hardware_model",
+        "Hardware vendor": "hardware_vendor",
+        "Operating system": "operating_system",
+        "Flatpak installed": "flatpak_installed",
+        "Flathub enabled": "flathub_enabled",
+        "File sharing": "file_sharing",
+        "Remote desktop": "remote_desktop",
+        "Remote login": "remote_login",
+        "Multimedia sharing": "multimedia_sharing",
+        "Workspaces only on primary": "workspaces_on_primary_display",
+        "Workspaces dynamic": "dynamic_or_fixed_workspaces",
+        "Number of users": "number_of_user_accounts",
+        "Default browser": "default_browser",
+    }
+
+    # ~ Collected data key -> expander row; its placeholder row is no_<name>,
+    # ~ and <name>_row holds the <name>_list Gtk.ListView showing the values
+    LISTS = {
+        "Online accounts": "online_accounts",
+        "Favourited apps": "favourited_apps",
+        "Installed apps": "installed_apps",
+        "Enabled extensions": "enabled_extensions",
+    }
+
+    PLACEHOLDER = "…"
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        
+
+        # ~ List views only realize the rows that are scrolled into view,
+        # ~ so long lists like installed apps stay cheap to show
+        self._list_models = dict()
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self._on_list_item_setup)
+        factory.connect("bind", self._on_list_item_bind)
+        for key, name in self.LISTS.items():
+            model = Gtk.StringList()
+            view = getattr(self, f"{name}_list")
+            view.set_model(Gtk.NoSelection(model=model))
+            view.set_factory(factory)
+            self._list_models[key] = model
+
+    def show_placeholders(self):
+        """Mark every row as pending until its probe reports back"""
+
+        for label in self.LABELS.values():
+            getattr(self, label).set_label(self.PLACEHOLDER)
+        self.salted_machine_id_hash.set_subtitle(self.PLACEHOLDER)
+        for name in self.LISTS.values():
+            getattr(self, name).set_subtitle(self.PLACEHOLDER)
+
+    def update_data(self, data: dict):
+        """Fill in the rows for the keys present in data
+
+        Called on the main loop every time a probe finishes, so data
+        usually holds only a few keys.
+        """
+
+        with trace.span("update_data", "ui", keys=len(data)):
+            for key, value in data.items():
+                if key in self.LABELS:
+                    getattr(self, self.LABELS[key]).set_label(str(value))
+                elif key in self.LISTS:
+                    self._fill_list(key, value)
+                elif key == "Unique ID":
+                    self.salted_machine_id_hash.set_subtitle(value)
+
+    def _fill_list(self, key: str, values):
+        name = self.LISTS[key]
+        expander = getattr(self, name)
+        placeholder = getattr(self, f"no_{name}")
+        list_row = getattr(self, f"{name}_row")
+        model = self._list_models[key]
+
+        if isinstance(values, str):  # Probe error or timeout
+            expander.set_subtitle(values)
+            values = []
+            placeholder.set_visible(False)
+        else:
+            expander.set_subtitle("")
+            placeholder.set_visible(not values)
+
+        # ~ Only replace the rows between the unchanged start and end, so
+        # ~ a live update of one item keeps the other rows and scrolling
+        new = [str(v) for v in values]
+        old = [model.get_string(i) for i in range(model.get_n_items())]
+        start = 0
+        while start < min(len(old), len(new)) and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < min(len(old), len(new)) - start and old[-1 - end] == new[-1 - end]:
+            end += 1
+        model.splice(start, len(old) - start - end, new[start:len(new) - end])
+        list_row.set_visible(bool(values))
+
+    def _on_list_item_setup(self, _factory, item):
+        item.set_child(Gtk.Label(xalign=0, ellipsize=Pango.EllipsizeMode.END,
+                                 margin_start=6, margin_end=6))
+
+    def _on_list_item_bind(self, _factory, item):
+        item.get_child().set_label(item.get_item().get_string())
+
     def save_window_props(self, *args):
         win_size = self.get_default_size()
 
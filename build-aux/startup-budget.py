@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# startup-budget.py
+#
+# Copyright 2022 Atrophaneura
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks startup costs against build-aux/startup-budget.json:
+#   client_import_ms  cumulative time of "import accumulate.client"
+#   first_frame_ms    launch until the first frame of the window is drawn
+#   rss_mb            peak resident memory when that frame is drawn
+# Exits non-zero when a measurement is over budget. Run with
+#   meson test -C _build --benchmark startup-budget
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(HERE)
+BUDGET_FILE = os.path.join(HERE, "startup-budget.json")
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)")
+
+
+def median(values: list) -> float:
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def client_import_ms() -> float:
+    """Cumulative import time of accumulate.client, from -X importtime"""
+
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import accumulate.client"],
+        cwd=SOURCE_DIR, capture_output=True, text=True, check=True,
+    )
+    for line in r.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match and match.group(2) == "accumulate.client":
+            return int(match.group(1)) / 1000
+    raise RuntimeError("accumulate.client missing from -X importtime output")
+
+
+def first_frame(launcher: str) -> tuple:
+    """Run the app until its first frame, return (ms, RSS in MB)"""
+
+    env = dict(os.environ, ACCUMULATE_STARTUP_PROBE="1")
+    start = time.monotonic()
+    r = subprocess.run([launcher], env=env, capture_output=True, text=True, timeout=60)
+    elapsed = (time.monotonic() - start) * 1000
+
+    match = re.search(r"startup-probe first-frame rss_kb=(\d+)", r.stdout)
+    if match is None:
+        raise RuntimeError(f"no first frame reported by {launcher}:\n{r.stderr}")
+    return elapsed, int(match.group(1)) / 1024
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check startup costs against a budget")
+    parser.add_argument("--launcher", help="local-accumulate script to time the first frame of")
+    parser.add_argument("--imports-only", action="store_true",
+                        help="only measure the import of accumulate.client")
+    parser.add_argument("--runs", type=int, default=5, help="runs per measurement, the median is kept")
+    parser.add_argument("--budget", default=BUDGET_FILE)
+    args = parser.parse_args()
+
+    with open(args.budget) as f:
+        budget = json.load(f)
+
+    measured = {"client_import_ms": median([client_import_ms() for _ in range(args.runs)])}
+    if not args.imports_only:
+        if not args.launcher:
+            parser.error("--launcher is needed unless --imports-only is given")
+        frames = [first_frame(args.launcher) for _ in range(args.runs)]
+        measured["first_frame_ms"] = median([ms for ms, _ in frames])
+        measured["rss_mb"] = median([mb for _, mb in frames])
+
+    over = False
+    for key, value in measured.items():
+        limit = budget[key]
+        status = "ok" if value <= limit else "OVER"
+        over = over or value > limit
+        print(f"{key:<18} {value:>9.1f} / {limit:<9} {status}")
+
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())